@@ -0,0 +1,39 @@
+import timeit
+from pathlib import Path
+
+from shapely import ops
+
+from new_caledonia_maps.geometry import swap_axes
+from new_caledonia_maps.natural_earth import parse_shapefile
+
+# Compares the old per-coordinate lambda used to swap lon/lat shapefile
+# coordinates against the vectorized `swap_axes` helper.
+data_path = Path(__file__).parent.parent.joinpath('data')
+land_shape_path = data_path.joinpath('ne_10m_land/ne_10m_land.shp')
+repeat = 5
+
+land_shapes = parse_shapefile(land_shape_path)
+
+
+def swap_with_lambda():
+    return list(map(
+        lambda geom: ops.transform(lambda x, y: (y, x), geom),
+        land_shapes
+    ))
+
+
+def swap_with_numpy():
+    return swap_axes(land_shapes)
+
+
+# Sanity check that both approaches produce the same geometries.
+for expected, actual in zip(swap_with_lambda(), swap_with_numpy()):
+    assert expected.equals_exact(actual, 0)
+
+lambda_seconds = min(timeit.repeat(swap_with_lambda, number=1, repeat=repeat))
+numpy_seconds = min(timeit.repeat(swap_with_numpy, number=1, repeat=repeat))
+
+print('ne_10m_land: %d geometries' % len(land_shapes))
+print('ops.transform lambda: %.3fs' % lambda_seconds)
+print('swap_axes:            %.3fs' % numpy_seconds)
+print('speedup:              %.1fx' % (lambda_seconds / numpy_seconds))
@@ -0,0 +1,219 @@
+import hashlib
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, \
+    wait
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, \
+    Set, Tuple
+
+from new_caledonia_maps.cache import cache_path
+
+stamp_path = cache_path.joinpath('build')
+
+_content_hashes: Dict[Tuple[Path, int, int], str] = {}
+
+
+def content_hash(path: Path) -> str:
+    """
+    Returns the SHA-1 of a file's contents. Hashes are remembered for as long
+    as the file's size and modification time stay the same, so a file that
+    is an input to several steps is only read once.
+    """
+    stat = path.stat()
+    key = (path.resolve(), stat.st_size, stat.st_mtime_ns)
+    if key not in _content_hashes:
+        digest = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        _content_hashes[key] = digest.hexdigest()
+    return _content_hashes[key]
+
+
+class BuildNode(NamedTuple):
+    name: str
+    func: Callable[[], None]
+    inputs: List[Path]
+    outputs: List[Path]
+    params: Tuple
+
+
+class BuildGraph:
+    """
+    A set of build steps, such as reprojecting a height map or tracing a
+    hillshade, that each read some files and write others.
+
+    Steps depend on the steps that produce their inputs. When the graph is
+    run, a step is only executed if the hash of its input files and
+    parameters has changed since it last succeeded, or if any of its outputs
+    are missing. Steps that do not depend on each other run concurrently.
+    """
+
+    def __init__(self):
+        self.nodes: Dict[str, BuildNode] = {}
+        self.producers: Dict[Path, str] = {}
+
+    def add(
+            self,
+            name: str,
+            func: Callable[[], None],
+            inputs: Iterable[Path] = (),
+            outputs: Iterable[Path] = (),
+            params: Tuple = ()
+    ):
+        """
+        Adds a step to the graph.
+
+        :param name: A unique name for the step, such as 'preview-hillshade'.
+        :param func: The function that performs the step. It takes no
+                     arguments, so use `functools.partial` to bind them.
+        :param inputs: The files the step reads.
+        :param outputs: The files the step writes.
+        :param params: Any other values that affect the outputs, such as the
+                       projection settings. They must have a stable `repr`.
+        :return:
+        """
+        if name in self.nodes:
+            raise Exception('Build step %s already exists' % name)
+        node = BuildNode(
+            name,
+            func,
+            [path.resolve() for path in inputs],
+            [path.resolve() for path in outputs],
+            params
+        )
+        for output in node.outputs:
+            if output in self.producers:
+                raise Exception('%s is already built by %s' % (
+                    output,
+                    self.producers[output]
+                ))
+            self.producers[output] = name
+        self.nodes[name] = node
+
+    def upstream(self, name: str) -> Set[str]:
+        """
+        Returns the names of the steps that produce the inputs of a step.
+        """
+        return {
+            self.producers[path]
+            for path in self.nodes[name].inputs
+            if path in self.producers
+        }
+
+    def _select(self, targets: Optional[Iterable[str]]) -> Set[str]:
+        if targets is None:
+            return set(self.nodes.keys())
+        selected = set()
+        queue = list(targets)
+        while len(queue) > 0:
+            name = queue.pop()
+            if name not in self.nodes:
+                raise Exception('Unknown build step %s' % name)
+            if name not in selected:
+                selected.add(name)
+                queue.extend(self.upstream(name))
+        return selected
+
+    def _key(self, node: BuildNode) -> str:
+        parts = [node.name, repr(node.params)]
+        for path in node.inputs:
+            if not path.exists():
+                raise Exception(
+                    'Missing input %s of build step %s' % (path, node.name)
+                )
+            parts.append('%s:%s' % (path.as_posix(), content_hash(path)))
+        parts.extend(path.as_posix() for path in node.outputs)
+        return hashlib.sha1('\0'.join(parts).encode()).hexdigest()
+
+    def _run_node(self, node: BuildNode, force: bool) -> bool:
+        key = self._key(node)
+        node_stamp_path = stamp_path.joinpath('%s.key' % node.name)
+        if not force and \
+                node_stamp_path.exists() and \
+                node_stamp_path.read_text() == key and \
+                all(path.exists() for path in node.outputs):
+            return False
+
+        for path in node.outputs:
+            path.parent.mkdir(parents=True, exist_ok=True)
+        node.func()
+        for path in node.outputs:
+            if not path.exists():
+                raise Exception(
+                    'Build step %s did not write %s' % (node.name, path)
+                )
+        node_stamp_path.parent.mkdir(parents=True, exist_ok=True)
+        node_stamp_path.write_text(key)
+        return True
+
+    def run(
+            self,
+            targets: Optional[Iterable[str]] = None,
+            force: bool = False,
+            jobs: Optional[int] = None
+    ):
+        """
+        Runs the stale steps of the graph.
+
+        Steps run on a thread pool, so they should spend their time in code
+        that releases the GIL, such as GDAL or subprocesses. If a step fails,
+        the steps that depend on it are skipped, the other steps carry on,
+        and an exception listing every failure is raised at the end.
+
+        :param targets: The names of the steps to bring up to date, along
+                        with everything they depend on. Defaults to all
+                        steps.
+        :param force: If true, every selected step runs, even if it is up to
+                      date.
+        :param jobs: The number of steps to run at once. Defaults to the
+                     number of CPUs.
+        :return:
+        """
+        selected = self._select(targets)
+        waiting_on = {
+            name: self.upstream(name) & selected for name in selected
+        }
+        running: Dict[Future, str] = {}
+        failures: List[Tuple[str, BaseException]] = []
+
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as \
+                executor:
+            while len(waiting_on) > 0 or len(running) > 0:
+                ready = sorted(
+                    name for name, upstream in waiting_on.items()
+                    if len(upstream) == 0
+                )
+                for name in ready:
+                    del waiting_on[name]
+                    future = executor.submit(
+                        self._run_node,
+                        self.nodes[name],
+                        force
+                    )
+                    running[future] = name
+
+                if len(running) == 0:
+                    # Everything left depends on a step that failed.
+                    break
+
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        print('failed:     %s (%s)' % (name, error))
+                        failures.append((name, error))
+                        continue
+                    print('%s %s' % (
+                        'built:     ' if future.result() else 'up to date:',
+                        name
+                    ))
+                    for upstream in waiting_on.values():
+                        upstream.discard(name)
+
+        if len(failures) > 0:
+            raise Exception('Build failed: %s; skipped: %s' % (
+                ', '.join(name for name, _ in failures),
+                ', '.join(sorted(waiting_on.keys())) or 'nothing'
+            ))
@@ -0,0 +1,108 @@
+import hashlib
+import os
+import pickle
+import tempfile
+from pathlib import Path
+from typing import BinaryIO, Callable, List
+
+import numpy as np
+import shapely
+from shapely.geometry.base import BaseGeometry
+
+cache_path = Path(__file__).parent.parent.joinpath('data/cache')
+
+
+def file_fingerprint(path: Path) -> str:
+    """
+    Returns a short hash that changes whenever the file at `path` is replaced
+    or modified, based on its name, size and modification time.
+    """
+    stat = path.stat()
+    return hashlib.sha1(
+        ('%s:%d:%d' % (path.name, stat.st_size, stat.st_mtime_ns)).encode()
+    ).hexdigest()[:16]
+
+
+def cache_file(name: str, *key_parts: str, suffix: str = '.npz') -> Path:
+    """
+    Returns the path of a cache entry named `name` whose contents depend on
+    `key_parts`. Different keys map to different files, so stale entries are
+    never read back.
+
+    :param name: A human-readable prefix for the cache entry.
+    :param key_parts: Strings that uniquely describe the cached contents.
+    :param suffix: The file extension of the cache entry.
+    :return:
+    """
+    key = hashlib.sha1('\0'.join(key_parts).encode()).hexdigest()[:16]
+    return cache_path.joinpath('%s-%s%s' % (name, key, suffix))
+
+
+def _write_atomically(path: Path, write: Callable[[BinaryIO], None]):
+    """
+    Writes a cache entry to a temporary file of its own, then moves it into
+    place, so that an interrupted run never leaves a truncated entry behind,
+    and processes writing the same entry at once never collide.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+            dir=path.parent,
+            prefix=path.name + '.',
+            suffix='.tmp',
+            delete=False
+    ) as file:
+        tmp_path = Path(file.name)
+        try:
+            write(file)
+        except BaseException:
+            file.close()
+            tmp_path.unlink(missing_ok=True)
+            raise
+    os.replace(tmp_path, path)
+
+
+def save_geoms(path: Path, geoms: List[BaseGeometry]):
+    """
+    Stores the geometries as a single WKB buffer with offsets, so that they
+    can be loaded back with one vectorized call to `shapely.from_wkb`.
+    """
+    wkbs = shapely.to_wkb(np.asarray(geoms, dtype=object))
+    offsets = np.zeros(len(wkbs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(wkb) for wkb in wkbs])
+    _write_atomically(path, lambda file: np.savez(
+        file,
+        wkb=np.frombuffer(b''.join(wkbs), dtype=np.uint8),
+        offsets=offsets
+    ))
+
+
+def load_geoms(path: Path) -> List[BaseGeometry]:
+    """
+    Loads geometries written by `save_geoms`.
+    """
+    with np.load(path) as data:
+        buffer = data['wkb'].tobytes()
+        offsets = data['offsets']
+    wkbs = np.array(
+        [buffer[start:end] for start, end in zip(offsets[:-1], offsets[1:])],
+        dtype=object
+    )
+    return list(shapely.from_wkb(wkbs))
+
+
+def save_object(path: Path, obj):
+    """
+    Pickles an arbitrary object, such as a parsed OSM map, to the cache.
+    """
+    _write_atomically(
+        path,
+        lambda file: pickle.dump(obj, file, protocol=pickle.HIGHEST_PROTOCOL)
+    )
+
+
+def load_object(path: Path):
+    """
+    Loads an object written by `save_object`.
+    """
+    with open(path, 'rb') as file:
+        return pickle.load(file)
@@ -0,0 +1,195 @@
+from functools import partial
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+import click
+import numpy as np
+from osgeo import gdal
+
+from new_caledonia_maps import dem, overview_hillshade, preview_hillshade
+from new_caledonia_maps.hillshade import hillshade_altitude, \
+    hillshade_azimuth, projected_height, relief_map_paths, srtm_tile_paths
+from new_caledonia_maps.preview_hillshade import srtm_tiles_path
+
+# Compares the NumPy reliefs and hillshades of `dem` against gdaldem's, on
+# the SRTM tiles, which are in degrees, and on the height maps projected for
+# the maps, as they are built. This is the scale gdaldem suggests for the
+# tiles, with heights in metres. The projected height maps are in metres.
+degrees_scale = 111120
+# The maps whose hillshades are computed from the SRTM tiles.
+projected_maps = {
+    'preview': preview_hillshade.reproject_height,
+    'overview': overview_hillshade.reproject_height,
+}
+
+
+def gdal_hillshade(height_path: Path, scale: float) -> np.ndarray:
+    gdal.UseExceptions()
+    shade = gdal.DEMProcessing(
+        '',
+        height_path.as_posix(),
+        'hillshade',
+        options=gdal.DEMProcessingOptions(
+            format='MEM',
+            band=1,
+            zFactor=1,
+            scale=scale,
+            azimuth=hillshade_azimuth,
+            altitude=hillshade_altitude
+        )
+    )
+    return shade.GetRasterBand(1).ReadAsArray()
+
+
+def gdal_color_relief(
+        height_path: Path,
+        color_map_path: Path
+) -> np.ndarray:
+    gdal.UseExceptions()
+    relief = gdal.DEMProcessing(
+        '',
+        height_path.as_posix(),
+        'color-relief',
+        options=gdal.DEMProcessingOptions(
+            format='MEM',
+            colorFilename=color_map_path.as_posix(),
+            band=1,
+            addAlpha=True,
+            colorSelection='linear_interpolation'
+        )
+    )
+    return np.dstack(relief.ReadAsArray())
+
+
+def difference(expected: np.ndarray, actual: np.ndarray) -> Tuple[int, float]:
+    """
+    :return: The largest difference between any two values, and the share of
+             the values that differ.
+    """
+    diff = np.abs(expected.astype(np.int16) - actual.astype(np.int16))
+    return int(diff.max()), np.count_nonzero(diff) / diff.size
+
+
+def compare_height(
+        height_path: Path,
+        height: np.ndarray,
+        geotransform: Sequence[float],
+        nodata: Optional[float],
+        scale: float
+) -> List[Tuple[str, int, float]]:
+    """
+    Computes the hillshade and color reliefs of a height map with both
+    engines.
+
+    :param height_path: The height map, for gdaldem.
+    :param height: The same height map, for `dem`.
+    :param geotransform:
+    :param nodata:
+    :param scale: See `dem.hillshade`.
+    :return: The name, largest difference and share of differing values of
+             each raster.
+    """
+    results = [(
+        'hillshade',
+        *difference(
+            gdal_hillshade(height_path, scale),
+            dem.hillshade(
+                height,
+                geotransform,
+                nodata,
+                azimuth=hillshade_azimuth,
+                altitude=hillshade_altitude,
+                scale=scale
+            )
+        )
+    )]
+    for theme, color_map_path in relief_map_paths.items():
+        ramp, nodata_color = dem.read_color_ramp(color_map_path)
+        results.append((
+            '%s relief' % theme,
+            *difference(
+                gdal_color_relief(height_path, color_map_path),
+                dem.color_relief(height, ramp, nodata, nodata_color)
+            )
+        ))
+    return results
+
+
+def compare_tile(hgt_path: Path) -> List[Tuple[str, int, float]]:
+    """
+    Compares the engines on an SRTM tile, memory-mapped for `dem`.
+    """
+    height, geotransform = dem.memmap_hgt(hgt_path)
+    return compare_height(
+        hgt_path,
+        height,
+        geotransform,
+        dem.srtm_nodata,
+        degrees_scale
+    )
+
+
+def compare_projected(
+        tile_paths: List[Path],
+        map_name: str
+) -> List[Tuple[str, int, float]]:
+    """
+    Compares the engines on the height map projected for a map, in memory
+    and streamed for `dem`, as `hillshade.build_relief` computes it.
+    """
+    reproject_height = projected_maps[map_name]
+    with projected_height(reproject_height, tile_paths) as height_path:
+        height = dem.RasterRows(height_path)
+        return compare_height(
+            height_path,
+            height,
+            height.geotransform,
+            height.nodata,
+            1
+        )
+
+
+@click.command()
+@click.option(
+    "--tolerance",
+    type=int,
+    default=1,
+    help='Fails if any value differs from gdaldem\'s by more than this.'
+)
+def compare(tolerance: int):
+    """
+    Compares the NumPy hillshade and color reliefs with gdaldem's on every
+    SRTM tile, and on the height map projected for each map.
+    """
+    tile_paths = srtm_tile_paths(srtm_tiles_path)
+    if len(tile_paths) == 0:
+        raise Exception('No SRTM tiles were found in %s' % srtm_tiles_path)
+
+    comparisons = [
+        (hgt_path.name, partial(compare_tile, hgt_path))
+        for hgt_path in tile_paths
+    ] + [
+        ('%s map' % map_name, partial(compare_projected, tile_paths, map_name))
+        for map_name in projected_maps.keys()
+    ]
+    failures = []
+    for height_name, compare_engines in comparisons:
+        for name, max_difference, share in compare_engines():
+            print('%-12s %-11s max difference %3d  differing %6.3f%%' % (
+                height_name,
+                name,
+                max_difference,
+                share * 100
+            ))
+            if max_difference > tolerance:
+                failures.append('%s %s' % (height_name, name))
+
+    if len(failures) > 0:
+        raise Exception(
+            'The NumPy rasters differ from gdaldem for %s' %
+            ', '.join(failures)
+        )
+
+
+if __name__ == '__main__':
+    compare()
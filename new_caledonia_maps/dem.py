@@ -0,0 +1,263 @@
+import math
+import re
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from osgeo import gdal
+
+# Rows of the height map are processed in blocks of this many rows, so that
+# memory-mapped height maps and `RasterRows` are streamed rather than read
+# all at once.
+block_rows = 512
+# The value of SRTM pixels without a height.
+srtm_nodata = -32768
+
+
+def memmap_hgt(hgt_path: Path) -> Tuple[np.memmap, Tuple[float, ...]]:
+    """
+    Memory-maps an SRTM tile, such as `N08W078.hgt`, without reading it.
+
+    :return: The heights, and the tile's geotransform in degrees.
+    """
+    match = re.fullmatch(r'([NS])(\d{2})([EW])(\d{3})', hgt_path.stem.upper())
+    if match is None:
+        raise Exception('Not an SRTM tile name: %s' % hgt_path.name)
+    lat = int(match.group(2)) * (1 if match.group(1) == 'N' else -1)
+    lon = int(match.group(4)) * (1 if match.group(3) == 'E' else -1)
+    size = math.isqrt(hgt_path.stat().st_size // 2)
+    heights = np.memmap(hgt_path, dtype='>i2', mode='r', shape=(size, size))
+    # The pixels are centred on the tile's edges, so the tiles overlap by a
+    # row and a column.
+    resolution = 1 / (size - 1)
+    geotransform = (
+        lon - resolution / 2,
+        resolution,
+        0,
+        lat + 1 + resolution / 2,
+        0,
+        -resolution
+    )
+    return heights, geotransform
+
+
+def _row_blocks(rows: int, start: int = 0, end: Optional[int] = None):
+    end = rows if end is None else end
+    for block_start in range(start, end, block_rows):
+        yield block_start, min(block_start + block_rows, end)
+
+
+def hillshade(
+        height: np.ndarray,
+        geotransform: Sequence[float],
+        nodata: Optional[float] = None,
+        azimuth: float = 312,
+        altitude: float = 45,
+        z_factor: float = 1,
+        scale: float = 1,
+        out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Shades a height map like `gdaldem hillshade`, using Horn's slope over
+    each pixel's 3x3 neighbourhood.
+
+    As with gdaldem, the edge pixels, and pixels next to a pixel without a
+    height, are 0, and every other pixel is between 1 and 255.
+
+    :param height: The height map. It may be memory-mapped, or a
+                   `RasterRows`, as it is read a block of rows at a time.
+    :param geotransform: The GDAL geotransform of the height map.
+    :param nodata: The height of pixels without a height.
+    :param azimuth: The direction of the light, in degrees clockwise from
+                    north.
+    :param altitude: The angle of the light above the horizon, in degrees.
+    :param z_factor: Exaggerates the heights by this factor.
+    :param scale: The ratio of the height map's horizontal units to its
+                  vertical units, such as 111120 for degrees and metres.
+    :param out: An array to write the shade into, such as a memory map.
+    :return: The shade, as bytes.
+    """
+    rows, cols = height.shape
+    if out is None:
+        out = np.zeros((rows, cols), dtype=np.uint8)
+    else:
+        out[0, :] = out[-1, :] = 0
+        out[:, 0] = out[:, -1] = 0
+
+    x_res = abs(geotransform[1]) * scale * 8
+    y_res = abs(geotransform[5]) * scale * 8
+    azimuth_radians = math.radians(azimuth)
+    altitude_radians = math.radians(altitude)
+    light_x = math.sin(azimuth_radians) * math.cos(altitude_radians)
+    light_y = math.cos(azimuth_radians) * math.cos(altitude_radians)
+    light_z = math.sin(altitude_radians)
+
+    for start, end in _row_blocks(rows, 1, rows - 1):
+        window = np.asarray(height[start - 1:end + 1], dtype=np.float64)
+        # The 3x3 neighbourhood of each pixel, named like gdaldem:
+        # a b c
+        # d e f
+        # g h i
+        a = window[:-2, :-2]
+        b = window[:-2, 1:-1]
+        c = window[:-2, 2:]
+        d = window[1:-1, :-2]
+        f = window[1:-1, 2:]
+        g = window[2:, :-2]
+        h = window[2:, 1:-1]
+        i = window[2:, 2:]
+        # The slope eastwards and northwards.
+        slope_x = ((c + 2 * f + i) - (a + 2 * d + g)) / x_res
+        slope_y = ((a + 2 * b + c) - (g + 2 * h + i)) / y_res
+        cos_angle = (
+            light_z
+            - z_factor * (slope_x * light_x + slope_y * light_y)
+        ) / np.sqrt(1 + z_factor ** 2 * (slope_x ** 2 + slope_y ** 2))
+        shade = np.floor(np.where(cos_angle > 0, 1 + 254 * cos_angle, 1) + 0.5)
+
+        if nodata is not None:
+            missing = window == nodata
+            missing = (
+                missing[:-2, :-2] | missing[:-2, 1:-1] | missing[:-2, 2:] |
+                missing[1:-1, :-2] | missing[1:-1, 1:-1] | missing[1:-1, 2:] |
+                missing[2:, :-2] | missing[2:, 1:-1] | missing[2:, 2:]
+            )
+            shade[missing] = 0
+        out[start:end, 1:-1] = shade
+    return out
+
+
+def read_color_ramp(
+        ramp_path: Path
+) -> Tuple[np.ndarray, Tuple[int, int, int, int]]:
+    """
+    Reads a color ramp in the format of `gdaldem color-relief`, with a height
+    and an RGB or RGBA color on each line.
+
+    :return: The ramp, as rows of height, red, green, blue and alpha, sorted
+             by height, and the color of pixels without a height.
+    """
+    entries = []
+    nodata_color = (0, 0, 0, 0)
+    for line in ramp_path.read_text().splitlines():
+        values = line.replace(',', ' ').split()
+        if len(values) == 0 or values[0].startswith('#'):
+            continue
+        if len(values) not in (4, 5):
+            raise Exception('Unsupported color ramp line: %s' % line)
+        color = tuple(int(value) for value in values[1:]) + (255,)
+        if values[0].lower() == 'nv':
+            nodata_color = color[:4]
+        elif values[0].endswith('%'):
+            raise Exception('Percentage heights are not supported: %s' % line)
+        else:
+            entries.append((float(values[0]),) + color[:4])
+    if len(entries) == 0:
+        raise Exception('The color ramp %s has no colors' % ramp_path)
+    ramp = np.array(sorted(entries), dtype=np.float64)
+    return ramp, nodata_color
+
+
+def color_relief(
+        height: np.ndarray,
+        ramp: np.ndarray,
+        nodata: Optional[float] = None,
+        nodata_color: Tuple[int, int, int, int] = (0, 0, 0, 0),
+        out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Colors a height map like `gdaldem color-relief -alpha` with linear
+    interpolation. Heights beyond the ends of the ramp take the color of the
+    nearest end.
+
+    :param height: The height map. It may be memory-mapped, or a
+                   `RasterRows`, as it is read a block of rows at a time.
+    :param ramp: See `read_color_ramp`.
+    :param nodata: The height of pixels without a height.
+    :param nodata_color: The color of pixels without a height.
+    :param out: An array to write the colors into, such as a memory map.
+    :return: The colors, as rows of red, green, blue and alpha bytes.
+    """
+    rows, cols = height.shape
+    if out is None:
+        out = np.zeros((rows, cols, 4), dtype=np.uint8)
+    for start, end in _row_blocks(rows):
+        values = np.asarray(height[start:end], dtype=np.float64)
+        for channel in range(4):
+            # gdaldem rounds the interpolated colors with an offset of 0.45.
+            out[start:end, :, channel] = np.floor(
+                np.interp(values, ramp[:, 0], ramp[:, channel + 1]) + 0.45
+            )
+        if nodata is not None:
+            out[start:end][values == nodata] = nodata_color
+    return out
+
+
+class RasterRows:
+    """
+    The first band of a raster, such as a GeoTIFF, that reads only the rows
+    it is sliced by, so that `hillshade` and `color_relief` stream it a block
+    of rows at a time rather than reading it all at once.
+
+    GDAL datasets must not be shared between threads, so each thread should
+    open its own.
+    """
+
+    def __init__(self, raster_path: Path):
+        gdal.UseExceptions()
+        self.dataset = gdal.Open(raster_path.as_posix())
+        self.band = self.dataset.GetRasterBand(1)
+        self.shape = (self.dataset.RasterYSize, self.dataset.RasterXSize)
+        self.geotransform = self.dataset.GetGeoTransform()
+        self.projection = self.dataset.GetProjection()
+        self.nodata = self.band.GetNoDataValue()
+
+    def __getitem__(self, rows: slice) -> np.ndarray:
+        start, end, _ = rows.indices(self.shape[0])
+        return self.band.ReadAsArray(0, start, self.shape[1], end - start)
+
+
+def write_raster(
+        raster_path: Path,
+        bands: np.ndarray,
+        raster_format: str,
+        creation_options: List[str],
+        geotransform: Optional[Sequence[float]] = None,
+        projection: Optional[str] = None,
+        nodata: Optional[float] = None
+):
+    """
+    Writes a byte raster with GDAL.
+
+    :param raster_path:
+    :param bands: A 2D array, or a 3D array with the bands last.
+    :param raster_format: A GDAL driver that supports CreateCopy, such as
+                          'GTiff' or 'PNG'.
+    :param creation_options: The driver's creation options.
+    :param geotransform:
+    :param projection:
+    :param nodata:
+    :return:
+    """
+    gdal.UseExceptions()
+    if bands.ndim == 2:
+        bands = bands[:, :, np.newaxis]
+    rows, cols, count = bands.shape
+    dataset = gdal.GetDriverByName('MEM').Create(
+        '', cols, rows, count, gdal.GDT_Byte
+    )
+    if geotransform is not None:
+        dataset.SetGeoTransform(geotransform)
+    if projection is not None:
+        dataset.SetProjection(projection)
+    for index in range(count):
+        band = dataset.GetRasterBand(index + 1)
+        band.WriteArray(bands[:, :, index])
+        if nodata is not None:
+            band.SetNoDataValue(nodata)
+    with gdal.config_option('GDAL_PAM_ENABLED', 'NO'):
+        gdal.GetDriverByName(raster_format).CreateCopy(
+            raster_path.as_posix(),
+            dataset,
+            options=creation_options
+        )
@@ -0,0 +1,155 @@
+import warnings
+from typing import List
+
+import numpy as np
+import shapely
+from shapely import STRtree
+from shapely.geometry import MultiPolygon
+from shapely.geometry.base import BaseGeometry
+
+
+def swap_axes(geoms: List[BaseGeometry]) -> List[BaseGeometry]:
+    """
+    Swaps the x and y coordinates of every geometry, for example to convert
+    lon/lat shapefile data to the lat/lon axis order of EPSG:4326.
+
+    All coordinates are swapped as a single NumPy array, instead of calling
+    back into Python for each coordinate.
+
+    :param geoms:
+    :return:
+    """
+    return list(shapely.transform(
+        np.asarray(geoms, dtype=object),
+        lambda coords: coords[:, ::-1]
+    ))
+
+
+def _polygon_parts(geom: BaseGeometry) -> np.ndarray:
+    """
+    Splits a geometry, or a collection of geometries, into its polygons.
+    """
+    parts = shapely.get_parts(shapely.get_parts(geom))
+    return parts[shapely.get_type_id(parts) == 3]
+
+
+def intersection_by_parts(
+        geom: BaseGeometry,
+        other: BaseGeometry
+) -> MultiPolygon:
+    """
+    Computes the intersection of two (multi-)polygons, such as an empire and
+    the world's land mass, one part at a time.
+
+    An STRtree over the parts of `other` limits each part of `geom` to the
+    parts whose envelopes overlap, and parts that lie entirely within the
+    other geometry are kept as they are, without running an overlay.
+
+    :param geom:
+    :param other:
+    :return:
+    """
+    geom_parts = _polygon_parts(geom)
+    other_parts = _polygon_parts(other)
+    geom_indices, other_indices = STRtree(other_parts).query(
+        geom_parts,
+        predicate='intersects'
+    )
+    a = geom_parts[geom_indices]
+    b = other_parts[other_indices]
+    shapely.prepare(a)
+    shapely.prepare(b)
+    a_within_b = shapely.contains_properly(b, a)
+    b_within_a = ~a_within_b & shapely.contains_properly(a, b)
+    overlapping = ~(a_within_b | b_within_a)
+
+    pieces = np.empty(len(a), dtype=object)
+    pieces[a_within_b] = a[a_within_b]
+    pieces[b_within_a] = b[b_within_a]
+    pieces[overlapping] = shapely.intersection(
+        a[overlapping],
+        b[overlapping]
+    )
+    return MultiPolygon(list(_polygon_parts(pieces)))
+
+
+def difference_by_parts(
+        geom: BaseGeometry,
+        other: BaseGeometry
+) -> MultiPolygon:
+    """
+    Subtracts `other` from `geom` one part at a time, such as lakes from
+    land. Each part of `geom` is only differenced against the parts of
+    `other` that intersect it, found with an STRtree; all other parts are
+    kept as they are.
+
+    :param geom:
+    :param other:
+    :return:
+    """
+    geom_parts = _polygon_parts(geom)
+    other_parts = _polygon_parts(other)
+    geom_indices, other_indices = STRtree(other_parts).query(
+        geom_parts,
+        predicate='intersects'
+    )
+    pieces = geom_parts.copy()
+    for geom_index in np.unique(geom_indices):
+        cutters = other_parts[other_indices[geom_indices == geom_index]]
+        pieces[geom_index] = geom_parts[geom_index].difference(
+            shapely.union_all(cutters)
+        )
+    return MultiPolygon(list(_polygon_parts(pieces)))
+
+
+def simplify_layers(
+        geoms: List[BaseGeometry],
+        tolerance: float
+) -> List[BaseGeometry]:
+    """
+    Simplifies canvas geometries to a tolerance below what can be seen, so
+    that they are quicker to draw and produce smaller files.
+
+    Polygonal layers that tile together without overlapping, such as the
+    land and the empires cut out of it, are simplified together as a
+    coverage, so the boundaries they share stay identical and no slivers
+    appear between them. They are first snapped to a grid a tenth of the
+    tolerance, so that boundaries left a hair apart by floating point
+    noise in the overlays are shared exactly. Otherwise, or with Shapely
+    older than 2.1, which has no coverage functions, each layer is
+    simplified on its own, preserving its topology, with a warning.
+
+    :param geoms:
+    :param tolerance: The simplification tolerance, in canvas units (pt). A
+                      layer simplified on its own keeps every vertex further
+                      than this from the simplified outline (Douglas-Peucker).
+                      A coverage is simplified with Visvalingam-Whyatt, which
+                      drops vertices whose triangle with their neighbours has
+                      an area below the tolerance squared. If zero, the
+                      geometries are returned unchanged.
+    :return:
+    """
+    if tolerance <= 0:
+        return list(geoms)
+    geoms = np.asarray(geoms, dtype=object)
+    simplified = shapely.simplify(geoms, tolerance, preserve_topology=True)
+    polygonal = np.isin(shapely.get_type_id(geoms), [3, 6]) & \
+        ~shapely.is_empty(geoms)
+    if polygonal.sum() <= 1:
+        return list(simplified)
+    if not hasattr(shapely, 'coverage_simplify'):
+        warnings.warn(
+            'Shapely %s has no coverage_simplify, so the layers are '
+            'simplified separately' % shapely.__version__
+        )
+        return list(simplified)
+    coverage = shapely.set_precision(geoms[polygonal], tolerance / 10)
+    if not shapely.coverage_is_valid(coverage):
+        warnings.warn(
+            'The layers do not form a valid coverage, so they are '
+            'simplified separately, and their shared boundaries may drift '
+            'apart'
+        )
+        return list(simplified)
+    simplified[polygonal] = shapely.coverage_simplify(coverage, tolerance)
+    return list(simplified)
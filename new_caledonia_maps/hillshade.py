@@ -0,0 +1,473 @@
+import os
+import subprocess
+import tempfile
+import uuid
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from osgeo import gdal
+
+from new_caledonia_maps import dem, tracer
+from new_caledonia_maps.build_graph import BuildGraph
+from new_caledonia_maps.cache import cache_path
+from new_caledonia_maps.parallel import thread_map
+from new_caledonia_maps.shade_levels import ShadeLevel, traced_svg_path
+
+root_path = Path(__file__).parent.parent
+relief_light_map_path = root_path.joinpath('data/color-relief-light.txt')
+relief_dark_map_path = root_path.joinpath('data/color-relief-dark.txt')
+relief_map_paths = {
+    'light': relief_light_map_path,
+    'dark': relief_dark_map_path
+}
+# Rasters are written tiled and with fast compression, as they are only
+# read back by the next steps of the build.
+# The GeoTIFF's blocks are compressed on every core.
+gtiff_creation_options = [
+    'TILED=YES',
+    'COMPRESS=DEFLATE',
+    'ZLEVEL=1',
+    'NUM_THREADS=ALL_CPUS'
+]
+png_creation_options = ['ZLEVEL=1']
+# Warps and compresses on every core, and caps GDAL's block cache (in MB),
+# so that large mosaics of height maps are streamed through rather than
+# held in memory.
+gdal_config_options = {
+    'GDAL_NUM_THREADS': 'ALL_CPUS',
+    'GDAL_CACHEMAX': '256'
+}
+# The direction and angle above the horizon of the hillshades' light.
+hillshade_azimuth = 312
+hillshade_altitude = 45
+# 'gdal' computes the reliefs and hillshades with gdaldem, 'numpy' with the
+# `dem` module.
+engines = ['gdal', 'numpy']
+# 'builtin' traces hillshades in-process with `tracer.trace`, 'potrace' runs
+# potrace in the docker container.
+tracers = ['builtin', 'potrace']
+
+
+def _docker_call(command: str) -> int:
+    return subprocess.call(
+        'docker run '
+        '--rm '
+        '-t '
+        '-v `pwd`:/root/mydata/ '
+        '-w /root/mydata/ '
+        'new-caledonia-maps-potrace '
+        '/bin/sh -c '
+        + "'" + command + "'",
+        shell=True,
+        cwd=root_path.as_posix()
+    )
+
+
+def _docker_path(path: Path) -> str:
+    # The repository is mounted as the container's working directory.
+    return path.resolve().relative_to(root_path.resolve()).as_posix()
+
+
+def docker_batch(stages: List[List[str]], jobs: Optional[int] = None):
+    """
+    Runs shell commands in a single container, rather than starting a
+    container for each of them.
+
+    The commands of a stage run in parallel, and each stage starts once the
+    previous one has completed. If any command fails, the later stages are
+    skipped, and the failed commands are reported with their output.
+
+    :param stages: The commands of each stage.
+    :param jobs: The number of commands to run at once. Defaults to the CPU
+                 count.
+    :return:
+    """
+    stages = [commands for commands in stages if len(commands) > 0]
+    if len(stages) == 0:
+        return
+    jobs = jobs or os.cpu_count() or 1
+    cache_path.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(
+            prefix='docker-batch-',
+            dir=cache_path,
+            ignore_cleanup_errors=True
+    ) as batch_dir:
+        batch_path = Path(batch_dir)
+        # Each command is written to its own script, so the commands are
+        # never quoted, and leave their output and exit status beside it.
+        for stage, commands in enumerate(stages):
+            for index, command in enumerate(commands):
+                batch_path.joinpath('%d-%04d.sh' % (stage, index)).write_text(
+                    command + '\n'
+                )
+        container_batch_path = _docker_path(batch_path)
+        batch_path.joinpath('batch.sh').write_text(
+            'for stage in %s; do\n'
+            '  ls %s/$stage-*.sh | xargs -P %d -n 1 sh -c '
+            '\'sh "$0" > "${0%%.sh}.log" 2>&1; '
+            'echo $? > "${0%%.sh}.status"\'\n'
+            '  if grep -q -v -x 0 %s/$stage-*.status; then exit 1; fi\n'
+            'done\n' % (
+                ' '.join(str(stage) for stage in range(len(stages))),
+                container_batch_path,
+                jobs,
+                container_batch_path
+            )
+        )
+        result = _docker_call('sh %s/batch.sh' % container_batch_path)
+
+        failures = []
+        for stage, commands in enumerate(stages):
+            for index, command in enumerate(commands):
+                name = '%d-%04d' % (stage, index)
+                status_path = batch_path.joinpath('%s.status' % name)
+                if not status_path.exists():
+                    failures.append('%s\n  (skipped or not run)' % command)
+                    continue
+                status = status_path.read_text().strip()
+                if status == '0':
+                    continue
+                log = batch_path.joinpath('%s.log' % name).read_text()
+                failures.append('%s\n  (exit status %s)\n%s' % (
+                    command,
+                    status,
+                    log.rstrip()
+                ))
+        # The container can fail without any command failing, such as when
+        # docker itself cannot start it.
+        if len(failures) > 0 or result != 0:
+            raise Exception(
+                'Failed to execute %d of %d docker commands (docker exit '
+                'status %d):\n%s' % (
+                    len(failures),
+                    sum(len(commands) for commands in stages),
+                    result,
+                    '\n'.join(failures)
+                )
+            )
+
+
+def relief_png_path(output_path: Path, theme: str) -> Path:
+    return output_path.joinpath('%s_relief.png' % theme)
+
+
+def color_relief(
+        height_path: Path,
+        color_map_path: Path,
+        relief_png_path: Path
+):
+    gdal.UseExceptions()
+    # The relief is colored in memory, and only encoded once, as the PNG
+    # that the maps draw.
+    relief = gdal.DEMProcessing(
+        '',
+        height_path.as_posix(),
+        'color-relief',
+        options=gdal.DEMProcessingOptions(
+            format='MEM',
+            colorFilename=color_map_path.as_posix(),
+            band=1,
+            addAlpha=True,
+            colorSelection='linear_interpolation'
+        )
+    )
+    with gdal.config_option('GDAL_PAM_ENABLED', 'NO'):
+        gdal.Translate(
+            relief_png_path.as_posix(),
+            relief,
+            options=gdal.TranslateOptions(
+                format='PNG',
+                creationOptions=png_creation_options
+            )
+        )
+
+
+def hillshade(height_path: Path, hillshade_tif_path: Path):
+    gdal.UseExceptions()
+    gdal.DEMProcessing(
+        hillshade_tif_path.as_posix(),
+        height_path.as_posix(),
+        'hillshade',
+        options=gdal.DEMProcessingOptions(
+            format='GTiff',
+            creationOptions=gtiff_creation_options,
+            band=1,
+            zFactor=1,
+            scale=1,
+            azimuth=hillshade_azimuth,
+            altitude=hillshade_altitude
+        )
+    )
+
+
+def numpy_relief_steps(
+        height_path: Path,
+        output_path: Path
+) -> List[Callable[[], None]]:
+    """
+    Returns the steps that compute the color reliefs and the hillshade with
+    `dem` rather than gdaldem. Each step streams the height map a block of
+    rows at a time, and holds only its own output in memory.
+    """
+
+    def write_hillshade():
+        height = dem.RasterRows(height_path)
+        dem.write_raster(
+            output_path.joinpath('projected.tif'),
+            dem.hillshade(
+                height,
+                height.geotransform,
+                height.nodata,
+                azimuth=hillshade_azimuth,
+                altitude=hillshade_altitude
+            ),
+            'GTiff',
+            gtiff_creation_options,
+            height.geotransform,
+            height.projection,
+            nodata=0
+        )
+
+    def write_color_relief(color_map_path: Path, png_path: Path):
+        height = dem.RasterRows(height_path)
+        ramp, nodata_color = dem.read_color_ramp(color_map_path)
+        dem.write_raster(
+            png_path,
+            dem.color_relief(height, ramp, height.nodata, nodata_color),
+            'PNG',
+            png_creation_options
+        )
+
+    return [
+        partial(
+            write_color_relief,
+            color_map_path,
+            relief_png_path(output_path, theme)
+        )
+        for theme, color_map_path in relief_map_paths.items()
+    ] + [write_hillshade]
+
+
+def srtm_tile_paths(tiles_path: Path) -> List[Path]:
+    """
+    Returns the SRTM height map tiles, such as `N08W078.hgt`, in a directory.
+    """
+    return sorted(tiles_path.glob('*.hgt'))
+
+
+def _run_with_gdal_config(step: Callable[[], None]):
+    # Configuration options are set per thread, so each worker sets its own.
+    with gdal.config_options(gdal_config_options):
+        step()
+
+
+@contextmanager
+def projected_height(
+        reproject_height: Callable[[Path, Path], None],
+        source_paths: List[Path]
+) -> Iterator[Path]:
+    """
+    Reprojects a mosaic of height maps into memory. The projected height map
+    is never written to disk, and is deleted on exit.
+
+    The tiles are only mosaicked virtually, so the warp reads just the blocks
+    of them that it needs, a window at a time. With the block cache capped,
+    the memory used depends on the size of the map rather than on the area
+    it covers.
+
+    :param reproject_height: Reprojects the height map at the first path to
+                             the second path.
+    :param source_paths: The tiles of the height map.
+    :return: The `/vsimem/` path of the projected height map.
+    """
+    gdal.UseExceptions()
+    if len(source_paths) == 0:
+        raise Exception('No height map tiles were found to reproject')
+    memory_path = '/vsimem/%s' % uuid.uuid4().hex
+    source_path = Path('%s/source.vrt' % memory_path)
+    height_path = Path('%s/projected_height.tif' % memory_path)
+    try:
+        gdal.BuildVRT(
+            source_path.as_posix(),
+            [path.as_posix() for path in source_paths]
+        )
+        with gdal.config_options(gdal_config_options):
+            reproject_height(source_path, height_path)
+        yield height_path
+    finally:
+        gdal.Unlink(source_path.as_posix())
+        gdal.Unlink(height_path.as_posix())
+
+
+def build_relief(
+        reproject_height: Callable[[Path, Path], None],
+        source_paths: List[Path],
+        output_path: Path,
+        engine: str = 'gdal'
+):
+    """
+    Reprojects a mosaic of height maps into memory, and writes the light and
+    dark color reliefs and the hillshade from it. The hillshade is written
+    to `projected.tif`, which the tracing steps read. See `projected_height`.
+
+    :param reproject_height: See `projected_height`.
+    :param source_paths: The tiles of the height map.
+    :param output_path: The directory to write the rasters to.
+    :param engine: One of `engines`.
+    :return:
+    """
+    output_path.mkdir(parents=True, exist_ok=True)
+    with projected_height(reproject_height, source_paths) as height_path:
+        # The reliefs and the hillshade only read the projected height map,
+        # so they run at once. GDAL and NumPy release the GIL while they
+        # compute.
+        if engine == 'numpy':
+            steps = numpy_relief_steps(height_path, output_path)
+        else:
+            steps = [
+                partial(
+                    color_relief,
+                    height_path,
+                    color_map_path,
+                    relief_png_path(output_path, theme)
+                )
+                for theme, color_map_path in relief_map_paths.items()
+            ] + [
+                partial(
+                    hillshade,
+                    height_path,
+                    output_path.joinpath('projected.tif')
+                )
+            ]
+        thread_map(_run_with_gdal_config, steps)
+
+
+def tiff_to_pnm_command(tif_path: Path, pnm_path: Path) -> str:
+    return 'tifftopnm %s > %s' % (
+        _docker_path(tif_path),
+        _docker_path(pnm_path)
+    )
+
+
+def potrace_command(
+        pnm_path: Path,
+        svg_path: Path,
+        threshold: float,
+        invert: bool
+) -> str:
+    return 'potrace %s -o %s -b svg -k %f%s' % (
+        _docker_path(pnm_path),
+        _docker_path(svg_path),
+        threshold,
+        ' -i' if invert else ''
+    )
+
+
+def add_relief_nodes(
+        graph: BuildGraph,
+        prefix: str,
+        output_path: Path,
+        source_paths: List[Path],
+        reproject_height: Callable[[Path, Path], None],
+        params: Tuple = (),
+        engine: str = 'gdal'
+):
+    """
+    Adds the step that reprojects a mosaic of height map tiles, and turns it
+    into the light and dark color reliefs, `<theme>_relief.png`, and into the
+    hillshade at `<output_path>/projected.tif`.
+
+    :param graph:
+    :param prefix: The prefix of the step names, such as 'preview'.
+    :param output_path: The directory to write the rasters to.
+    :param source_paths: The tiles of the height map to reproject.
+    :param reproject_height: See `build_relief`.
+    :param params: The parameters of the reprojection.
+    :param engine: One of `engines`.
+    :return:
+    """
+    graph.add(
+        '%s-relief' % prefix,
+        partial(
+            build_relief,
+            reproject_height,
+            source_paths,
+            output_path,
+            engine
+        ),
+        inputs=source_paths + list(relief_map_paths.values()),
+        outputs=[
+            relief_png_path(output_path, theme)
+            for theme in relief_map_paths.keys()
+        ] + [output_path.joinpath('projected.tif')],
+        params=params + (engine, hillshade_azimuth, hillshade_altitude)
+    )
+
+
+def add_shade_nodes(
+        graph: BuildGraph,
+        prefix: str,
+        output_path: Path,
+        hillshade_tif_path: Path,
+        levels: List[ShadeLevel],
+        tracer_name: str = 'builtin'
+):
+    """
+    Adds the steps that trace a hillshade at each of the shade levels, to
+    `<name>_<threshold>.svg`.
+
+    With potrace, the conversion to PNM and the tracing of every level run in
+    a single docker container, as one step.
+
+    :param graph:
+    :param prefix: The prefix of the step names, such as 'preview'.
+    :param output_path: The directory to write the SVGs to.
+    :param hillshade_tif_path: The projected hillshade.
+    :param levels:
+    :param tracer_name: One of `tracers`.
+    :return:
+    """
+    traced_svg_paths = [
+        traced_svg_path(output_path, level) for level in levels
+    ]
+    if tracer_name == 'potrace':
+        pnm_path = output_path.joinpath('projected.pnm')
+        trace_commands = [
+            potrace_command(
+                pnm_path,
+                svg_path,
+                level.threshold,
+                level.invert
+            )
+            for level, svg_path in zip(levels, traced_svg_paths)
+        ]
+        graph.add(
+            '%s-potrace' % prefix,
+            partial(docker_batch, [
+                [tiff_to_pnm_command(hillshade_tif_path, pnm_path)],
+                trace_commands
+            ]),
+            inputs=[hillshade_tif_path],
+            outputs=[pnm_path] + traced_svg_paths,
+            params=tuple((level.threshold, level.invert) for level in levels)
+        )
+    else:
+        # The hillshade is read once, and every level traced from it.
+        graph.add(
+            '%s-trace' % prefix,
+            partial(
+                tracer.trace_levels,
+                hillshade_tif_path,
+                [
+                    (svg_path, level.threshold, level.invert)
+                    for level, svg_path in zip(levels, traced_svg_paths)
+                ]
+            ),
+            inputs=[hillshade_tif_path],
+            outputs=traced_svg_paths,
+            params=(tracer_name,) + tuple(
+                (level.threshold, level.invert) for level in levels
+            )
+        )
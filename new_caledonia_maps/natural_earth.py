@@ -0,0 +1,61 @@
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import shapefile
+from shapely.geometry import shape
+from shapely.geometry.base import BaseGeometry
+
+from new_caledonia_maps.cache import cache_file, file_fingerprint, \
+    load_geoms, save_geoms
+from new_caledonia_maps.geometry import swap_axes
+
+
+def parse_shapefile(
+        shapefile_path: Path,
+        lat_lon_order: bool = False,
+        bbox: Optional[Tuple[float, float, float, float]] = None
+) -> List[BaseGeometry]:
+    """
+    Reads the geometries of a shapefile, such as the Natural Earth land and
+    lake datasets.
+
+    The parsed geometries are cached as WKB next to the other data, so
+    subsequent runs can skip pyshp and decode everything in one vectorized
+    call. The cache is invalidated whenever the shapefile changes.
+
+    :param shapefile_path:
+    :param lat_lon_order: Shapefiles store coordinates as lon/lat. If true,
+                          the axes are swapped to match EPSG:4326 before the
+                          geometries are cached.
+    :param bbox: If set, only records whose bounding box intersects this
+                 `(min_x, min_y, max_x, max_y)` box are read, using the
+                 per-record bounding boxes stored in the shapefile. The box
+                 uses the same axis order as the returned geometries.
+    :return:
+    """
+    cache_path = cache_file(
+        shapefile_path.stem,
+        shapefile_path.resolve().as_posix(),
+        file_fingerprint(shapefile_path),
+        'lat_lon' if lat_lon_order else 'lon_lat',
+        repr(bbox)
+    )
+    if cache_path.exists():
+        return load_geoms(cache_path)
+
+    shapefile_bbox = bbox
+    if bbox is not None and lat_lon_order:
+        shapefile_bbox = (bbox[1], bbox[0], bbox[3], bbox[2])
+
+    shapefile_collection = shapefile.Reader(shapefile_path.as_posix())
+    shapely_objects = []
+    # pyshp compares each record's bbox before decoding its points, so
+    # records outside the box never reach Shapely.
+    for shape_record in shapefile_collection.iterShapes(bbox=shapefile_bbox):
+        shapely_objects.append(shape(shape_record.__geo_interface__))
+    shapefile_collection.close()
+    if lat_lon_order:
+        shapely_objects = swap_axes(shapely_objects)
+
+    save_geoms(cache_path, shapely_objects)
+    return shapely_objects
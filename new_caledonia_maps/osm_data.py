@@ -0,0 +1,316 @@
+from array import array
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from xml.etree import ElementTree
+
+import numpy as np
+from map_engraver.data.osm import Parser
+
+from new_caledonia_maps.cache import cache_file, file_fingerprint, \
+    load_object, save_object
+
+Tags = List[Tuple[str, str]]
+
+# Maps that have already been parsed by this process, by cache path.
+_loaded_maps: Dict[Path, object] = {}
+
+
+def parse_osm(
+        osm_path: Path,
+        way_tags: Optional[Tags] = None,
+        relation_tags: Optional[Tags] = None,
+        bbox: Optional[Tuple[float, float, float, float]] = None
+):
+    """
+    Parses an OSM XML file, like `Parser.parse`, but keeps a pickled snapshot
+    of the parsed map in the cache. Subsequent runs load the snapshot
+    instead of parsing the XML again, until the source file changes. Within
+    a process, each map is only loaded once.
+
+    If any filters are given, the file is first streamed through
+    `extract_osm`, so only the matching elements are ever held in memory.
+
+    :param osm_path:
+    :param way_tags: See `extract_osm`.
+    :param relation_tags: See `extract_osm`.
+    :param bbox: See `extract_osm`.
+    :return:
+    """
+    cache_path = cache_file(
+        osm_path.stem,
+        osm_path.resolve().as_posix(),
+        file_fingerprint(osm_path),
+        repr(way_tags),
+        repr(relation_tags),
+        repr(bbox),
+        suffix='.pickle'
+    )
+    if cache_path in _loaded_maps:
+        return _loaded_maps[cache_path]
+    if cache_path.exists():
+        osm_map = load_object(cache_path)
+        _loaded_maps[cache_path] = osm_map
+        return osm_map
+
+    if way_tags is None and relation_tags is None and bbox is None:
+        osm_map = Parser.parse(osm_path)
+    else:
+        extract_path = cache_path.with_suffix('.osm')
+        extract_osm(osm_path, extract_path, way_tags, relation_tags, bbox)
+        osm_map = Parser.parse(extract_path)
+        extract_path.unlink()
+    save_object(cache_path, osm_map)
+    _loaded_maps[cache_path] = osm_map
+    return osm_map
+
+
+def loaded_osm_maps() -> Dict[Path, object]:
+    """
+    Returns the maps loaded by `parse_osm` in this process, so they can be
+    handed to worker processes with `share_osm_maps`.
+    """
+    return dict(_loaded_maps)
+
+
+def share_osm_maps(osm_maps: Dict[Path, object]):
+    """
+    Makes maps loaded by another process available to `parse_osm`, for
+    example in the initializer of a process pool.
+    """
+    _loaded_maps.update(osm_maps)
+
+
+def _iter_elements(osm_path: Path) -> Iterator[ElementTree.Element]:
+    """
+    Yields the top-level elements of an OSM file one at a time, discarding
+    each one once the caller is done with it.
+    """
+    context = ElementTree.iterparse(osm_path, events=('start', 'end'))
+    _, root = next(context)
+    for event, element in context:
+        if event == 'end' and element.tag in ('bounds', 'node', 'way',
+                                              'relation'):
+            yield element
+            root.clear()
+
+
+def _matches(element: ElementTree.Element, tags: Optional[Tags]) -> bool:
+    if tags is None:
+        return False
+    for tag in element.iterfind('tag'):
+        if (tag.get('k'), tag.get('v')) in tags:
+            return True
+    return False
+
+
+def _outcode(
+        lat: float,
+        lon: float,
+        bbox: Tuple[float, float, float, float]
+) -> int:
+    # Which sides of the box a point lies beyond, as bits, or 0 if inside.
+    return (
+        (lat < bbox[0]) * 1 |
+        (lat > bbox[2]) * 2 |
+        (lon < bbox[1]) * 4 |
+        (lon > bbox[3]) * 8
+    )
+
+
+class _NodeOutcodes:
+    """
+    The outcodes of every node in a file, by id. They are kept in two flat
+    arrays rather than a dict, so that each node takes 9 bytes, and looked up
+    by binary search once all the nodes have been added.
+    """
+
+    def __init__(self):
+        self._ids = array('q')
+        self._codes = array('B')
+        self._ids_sorted = None
+        self._codes_sorted = None
+
+    def add(self, node_id: int, code: int):
+        self._ids.append(node_id)
+        self._codes.append(code)
+
+    def _freeze(self):
+        ids = np.frombuffer(self._ids, dtype=np.int64)
+        codes = np.frombuffer(self._codes, dtype=np.uint8)
+        # Nodes are usually sorted by id already, so this rarely copies.
+        if np.any(ids[1:] < ids[:-1]):
+            order = np.argsort(ids, kind='stable')
+            ids, codes = ids[order], codes[order]
+        self._ids_sorted, self._codes_sorted = ids, codes
+
+    def lookup(self, refs: List[int]) -> np.ndarray:
+        """
+        Returns the outcodes of the nodes in order, skipping any that are not
+        in the file.
+        """
+        if self._ids_sorted is None:
+            self._freeze()
+        if len(self._ids_sorted) == 0:
+            return np.zeros(0, dtype=np.uint8)
+        refs = np.asarray(refs, dtype=np.int64)
+        index = np.minimum(
+            np.searchsorted(self._ids_sorted, refs),
+            len(self._ids_sorted) - 1
+        )
+        found = self._ids_sorted[index] == refs
+        return self._codes_sorted[index[found]]
+
+
+def _way_touches_bbox(refs: List[int], node_outcodes: _NodeOutcodes) -> bool:
+    """
+    Returns whether a way has a node inside the box, or a segment that may
+    cross it. A segment whose ends lie beyond the same side of the box can
+    never cross it. Segments passing just outside a corner are kept as well,
+    which only adds a few ways to the extract.
+    """
+    codes = node_outcodes.lookup(refs)
+    return bool(
+        np.any(codes == 0) or
+        np.any((codes[:-1] & codes[1:]) == 0)
+    )
+
+
+def extract_osm(
+        osm_path: Path,
+        output_path: Path,
+        way_tags: Optional[Tags] = None,
+        relation_tags: Optional[Tags] = None,
+        bbox: Optional[Tuple[float, float, float, float]] = None
+):
+    """
+    Streams an OSM XML file and writes a smaller OSM file containing only the
+    ways and relations that match the filters, plus the ways and nodes they
+    reference. Apart from 9 bytes per node of the source file when filtering
+    by `bbox`, memory use depends on the size of the selection, not on the
+    size of the source file.
+
+    :param osm_path:
+    :param output_path:
+    :param way_tags: Ways with any of these `(key, value)` tags are kept.
+    :param relation_tags: Relations with any of these `(key, value)` tags
+                          are kept, along with their member ways.
+    :param bbox: If set, as `(min_lat, min_lon, max_lat, max_lon)`, only ways
+                 with a node or a segment inside the box, and relations with
+                 at least one such member, are kept. Ways crossing the box
+                 without a node inside it are kept too, so coastlines are
+                 never cut open.
+    :return:
+    """
+    # First pass: decide which ways and relations to keep. Nodes always
+    # precede ways, and ways precede relations, so a single pass is enough
+    # to know whether an element touches the bounding box.
+    node_outcodes = _NodeOutcodes()
+    bbox_ways: Set[str] = set()
+    selected_ways: Set[str] = set()
+    selected_relations: Set[str] = set()
+    selected_nodes: Set[str] = set()
+    for element in _iter_elements(osm_path):
+        if element.tag == 'node':
+            if bbox is not None:
+                node_outcodes.add(int(element.get('id')), _outcode(
+                    float(element.get('lat')),
+                    float(element.get('lon')),
+                    bbox
+                ))
+        elif element.tag == 'way':
+            in_bbox = bbox is None or _way_touches_bbox(
+                [int(nd.get('ref')) for nd in element.iterfind('nd')],
+                node_outcodes
+            )
+            if not in_bbox:
+                continue
+            if bbox is not None and relation_tags is not None:
+                bbox_ways.add(element.get('id'))
+            if _matches(element, way_tags):
+                selected_ways.add(element.get('id'))
+        elif element.tag == 'relation':
+            if not _matches(element, relation_tags):
+                continue
+            members = list(element.iterfind('member'))
+            if bbox is not None and not any(
+                    (member.get('type') == 'way' and
+                     member.get('ref') in bbox_ways) or
+                    (member.get('type') == 'node' and
+                     np.any(node_outcodes.lookup(
+                         [int(member.get('ref'))]
+                     ) == 0))
+                    for member in members
+            ):
+                continue
+            selected_relations.add(element.get('id'))
+            for member in members:
+                if member.get('type') == 'way':
+                    selected_ways.add(member.get('ref'))
+                elif member.get('type') == 'node':
+                    selected_nodes.add(member.get('ref'))
+    del node_outcodes, bbox_ways
+
+    # Second pass: collect the nodes referenced by the kept ways.
+    for element in _iter_elements(osm_path):
+        if element.tag == 'way' and element.get('id') in selected_ways:
+            selected_nodes.update(
+                nd.get('ref') for nd in element.iterfind('nd')
+            )
+        elif element.tag == 'relation':
+            break
+
+    # Third pass: write the selection out.
+    selected = {
+        'bounds': None,
+        'node': selected_nodes,
+        'way': selected_ways,
+        'relation': selected_relations,
+    }
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'wb') as file:
+        file.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
+        file.write(b"<osm version='0.6'>\n")
+        for element in _iter_elements(osm_path):
+            ids = selected[element.tag]
+            if ids is None or element.get('id') in ids:
+                element.tail = '\n'
+                file.write(ElementTree.tostring(
+                    element,
+                    encoding='utf-8',
+                    xml_declaration=False
+                ))
+        file.write(b'</osm>\n')
+
+
+class OsmTagIndex:
+    """
+    Maps `(key, value)` tag pairs to the nodes, ways and relations of a
+    parsed OSM map, so elements can be looked up by tag without scanning the
+    whole map with `filter_elements` each time.
+
+    The index is built in a single pass over the map. Elements are returned
+    in the same order as they appear in the map.
+    """
+
+    def __init__(self, osm_map):
+        self.node_index = self._build(osm_map.nodes)
+        self.way_index = self._build(osm_map.ways)
+        self.relation_index = self._build(osm_map.relations)
+
+    @staticmethod
+    def _build(elements: dict) -> Dict[Tuple[str, str], list]:
+        index = defaultdict(list)
+        for element in elements.values():
+            for tag in element.tags.items():
+                index[tag].append(element)
+        return dict(index)
+
+    def nodes(self, key: str, value: str) -> list:
+        return self.node_index.get((key, value), [])
+
+    def ways(self, key: str, value: str) -> list:
+        return self.way_index.get((key, value), [])
+
+    def relations(self, key: str, value: str) -> list:
+        return self.relation_index.get((key, value), [])
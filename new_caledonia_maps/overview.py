@@ -1,11 +1,11 @@
-import glob
-
 import math
 from pathlib import Path
+from typing import Callable, NamedTuple
 
 import cairocffi
 import click
 from map_engraver.canvas import CanvasBuilder
+from map_engraver.canvas.canvas_bbox import CanvasBbox
 from map_engraver.canvas.canvas_coordinate import CanvasCoordinate
 from map_engraver.canvas.canvas_unit import CanvasUnit as Cu
 from map_engraver.data.canvas_geometry.rect import rect
@@ -16,8 +16,6 @@ from map_engraver.data.geo_canvas_ops.geo_canvas_transformers_builder import \
     GeoCanvasTransformersBuilder
 from map_engraver.data.geotiff.canvas_transform import \
     build_geotiff_crs_within_canvas_matrix
-from map_engraver.data.osm import Parser
-from map_engraver.data.osm.filter import filter_elements
 from map_engraver.data.osm_shapely.natural_coastline import \
     CoastlineOutputType, \
     natural_coastline_to_multi_polygon
@@ -29,101 +27,99 @@ from map_engraver.drawable.images.svg import Svg
 from pangocffi import Alignment
 from pyproj import CRS
 from shapely.geometry import Point
-from shapely.ops import transform, unary_union
+from shapely.geometry.base import BaseGeometry
+from shapely.ops import unary_union
 
 from new_caledonia_maps.annotation import draw_annotation
+from new_caledonia_maps.geometry import simplify_layers
 from new_caledonia_maps.map_scale import draw_map_scale
+from new_caledonia_maps.osm_data import OsmTagIndex, parse_osm
+from new_caledonia_maps.projection import transform_to_canvas
+from new_caledonia_maps.shade_layer import draw_shade_levels
+from new_caledonia_maps.shade_levels import overview_output_path, \
+    overview_shade_levels
+
+
+class OverviewLayers(NamedTuple):
+    canvas_width: Cu
+    canvas_height: Cu
+    canvas_bbox: CanvasBbox
+    builder: GeoCanvasTransformersBuilder
+    wgs84_crs: CRS
+    wgs84_to_canvas: Callable
+    mask_canvas: BaseGeometry
+    water_canvas: BaseGeometry
+    beaches_canvas: BaseGeometry
+    boat_path_canvas: BaseGeometry
+    shade_matrix: cairocffi.Matrix
+
+
+# The area of New Caledonia's OSM data that the map shows.
+coastline_bbox = (8.750, -77.80, 9.000, -77.5)
+
+
+def parse_osm_data():
+    """
+    Parses the OSM data the overview map reads: the coastline and beaches of
+    New Caledonia, and the custom data for the preview map.
+    """
+    data_path = Path(__file__).parent.parent.joinpath('data')
+    nc_path = data_path.joinpath('new_caledonia.osm')
+    osm_preview_path = data_path.joinpath('preview.osm')
 
+    # Read OSM data for New Caledonia. The extract is streamed so that only
+    # the coastline and beaches near the map are kept in memory.
+    osm_map = parse_osm(
+        nc_path,
+        way_tags=[('natural', 'coastline')],
+        relation_tags=[('natural', 'beach')],
+        bbox=coastline_bbox
+    )
+    osm_preview_map = parse_osm(osm_preview_path)
+    return osm_map, osm_preview_map
 
-@click.command()
-@click.option(
-    "--dark/--light",
-    default=False,
-    help='Disables anti-aliasing when rendering the image.'
-)
-def render(
-        dark: bool,
-):
-    name = 'overview-light.svg'
 
+def prepare(simplify_tolerance: float = 0.25) -> OverviewLayers:
+    """
+    Computes all the theme-independent geometry of the overview map, already
+    projected onto the canvas.
+
+    :param simplify_tolerance: The tolerance, in pixels, that the projected
+                               layers are simplified to before drawing.
+    :return:
+    """
     root_path = Path(__file__).parent.parent
     data_path = root_path.joinpath('data')
-    img_path = root_path.joinpath('img')
-
-    sea_color = (0 / 255, 101 / 255, 204 / 255)
-    # sea_color = (200/255, 200/255, 200/255)
-    land_color = (183 / 255, 218 / 255, 158 / 255)
-    # land_color = (230/255, 230/255, 230/255)
-    beach_color = (255 / 255, 245 / 255, 208 / 255)
-    boat_path = (255 / 255, 255 / 255, 255 / 255)
-    ship_side_path = img_path.joinpath('ship_side_light.svg')
-    hillshade_glob = 'data/overview_shaded_relief/light_*.svg'
-    height_path = data_path.joinpath('overview_shaded_relief/light_relief.png')
-    if dark:
-        name = 'overview-dark.svg'
-        sea_color = (0 / 255, 36 / 255, 125 / 255)
-        land_color = (76 / 255, 141 / 255, 146 / 255)
-        beach_color = (176 / 255, 176 / 255, 104 / 255)
-        boat_path = (184 / 255, 204 / 255, 255 / 255)
-        ship_side_path = img_path.joinpath('ship_side_dark.svg')
-        hillshade_glob = 'data/overview_shaded_relief/dark_*.svg'
-        height_path = data_path.joinpath(
-            'overview_shaded_relief/dark_relief.png'
-        )
 
-    nc_path = data_path.joinpath('new_caledonia.osm')
-    osm_preview_path = data_path.joinpath('preview.osm')
     shade_tiff = data_path.joinpath('overview_shaded_relief/projected.tif')
 
-    # Read OSM data for New Caledonia
-    osm_map = Parser.parse(nc_path)
+    osm_map, osm_preview_map = parse_osm_data()
     osm_to_shapely = OsmToShapely(osm_map)
 
     water_wgs84 = natural_coastline_to_multi_polygon(
         osm_map,
-        (8.750, -77.80, 9.000, -77.5),
+        coastline_bbox,
         CoastlineOutputType.WATER
     )
-    beaches_relations = filter_elements(
-        osm_map,
-        lambda _, relation: (
-                'natural' in relation.tags and
-                relation.tags['natural'] == 'beach'
-        ),
-        filter_ways=False,
-        filter_nodes=False,
-    )
+    osm_index = OsmTagIndex(osm_map)
     beaches_wgs84 = unary_union(list(map(
         lambda relation: osm_to_shapely.relation_to_multi_polygon(relation),
-        list(beaches_relations.relations.values())
+        osm_index.relations('natural', 'beach')
     )))
 
     # Read custom data for the preview map
-    osm_preview_map = Parser.parse(osm_preview_path)
     osm_preview_to_shapely = OsmToShapely(osm_preview_map)
 
-    boat_way = filter_elements(
-        osm_preview_map, lambda _, way: (
-                'name' in way.tags and way.tags['name'] == 'First Expedition'
-        ),
-        filter_nodes=False,
-        filter_relations=False
-    )
+    osm_preview_index = OsmTagIndex(osm_preview_map)
     boat_path_wgs84 = osm_preview_to_shapely.way_to_line_string(
-        list(boat_way.ways.values())[0]
+        osm_preview_index.ways('name', 'First Expedition')[0]
     )
 
-    # Build the canvas
-    Path(__file__).parent.parent.joinpath('output/') \
-        .mkdir(parents=True, exist_ok=True)
-    path = Path(__file__).parent.parent.joinpath('output/%s' % name)
-    path.unlink(missing_ok=True)
+    # Build the canvas bounds
     canvas_builder = CanvasBuilder()
-    canvas_builder.set_path(path)
     canvas_width = Cu.from_px(720)
     canvas_height = Cu.from_px(720)
     canvas_builder.set_size(canvas_width, canvas_height)
-    canvas = canvas_builder.build()
     canvas_bbox = canvas_builder.build_bbox()
 
     # Now let's sort out the projection system
@@ -147,46 +143,108 @@ def render(
     # Generate the transformers
     wgs84_to_canvas = builder.build_crs_to_canvas_transformer()
 
-    water_canvas = transform(wgs84_to_canvas, water_wgs84)
-    beaches_canvas = transform(wgs84_to_canvas, beaches_wgs84)
-    boat_path_canvas = transform(wgs84_to_canvas, boat_path_wgs84)
+    water_canvas = transform_to_canvas(builder, water_wgs84)
+    beaches_canvas = transform_to_canvas(builder, beaches_wgs84)
+    boat_path_canvas = transform_to_canvas(builder, boat_path_wgs84)
+    water_canvas, beaches_canvas, boat_path_canvas = simplify_layers(
+        [water_canvas, beaches_canvas, boat_path_canvas],
+        Cu.from_px(simplify_tolerance).pt
+    )
+
+    shade_matrix = build_geotiff_crs_within_canvas_matrix(
+        # Add padding to avoid hill-shade edges appearing on map
+        rect(canvas_bbox).buffer(Cu.from_px(10).pt),
+        builder,
+        shade_tiff
+    )
+
+    return OverviewLayers(
+        canvas_width=canvas_width,
+        canvas_height=canvas_height,
+        canvas_bbox=canvas_bbox,
+        builder=builder,
+        wgs84_crs=wgs84_crs,
+        wgs84_to_canvas=wgs84_to_canvas,
+        mask_canvas=mask_canvas,
+        water_canvas=water_canvas,
+        beaches_canvas=beaches_canvas,
+        boat_path_canvas=boat_path_canvas,
+        shade_matrix=shade_matrix
+    )
+
+
+def draw(layers: OverviewLayers, dark: bool):
+    """
+    Draws the overview map using either the light or dark theme.
+    """
+    name = 'overview-light.svg'
+
+    root_path = Path(__file__).parent.parent
+    data_path = root_path.joinpath('data')
+    img_path = root_path.joinpath('img')
+
+    sea_color = (0 / 255, 101 / 255, 204 / 255)
+    # sea_color = (200/255, 200/255, 200/255)
+    land_color = (183 / 255, 218 / 255, 158 / 255)
+    # land_color = (230/255, 230/255, 230/255)
+    beach_color = (255 / 255, 245 / 255, 208 / 255)
+    boat_path = (255 / 255, 255 / 255, 255 / 255)
+    ship_side_path = img_path.joinpath('ship_side_light.svg')
+    height_path = data_path.joinpath('overview_shaded_relief/light_relief.png')
+    if dark:
+        name = 'overview-dark.svg'
+        sea_color = (0 / 255, 36 / 255, 125 / 255)
+        land_color = (76 / 255, 141 / 255, 146 / 255)
+        beach_color = (176 / 255, 176 / 255, 104 / 255)
+        boat_path = (184 / 255, 204 / 255, 255 / 255)
+        ship_side_path = img_path.joinpath('ship_side_dark.svg')
+        height_path = data_path.joinpath(
+            'overview_shaded_relief/dark_relief.png'
+        )
+
+    # Build the canvas
+    Path(__file__).parent.parent.joinpath('output/') \
+        .mkdir(parents=True, exist_ok=True)
+    path = Path(__file__).parent.parent.joinpath('output/%s' % name)
+    path.unlink(missing_ok=True)
+    canvas_builder = CanvasBuilder()
+    canvas_builder.set_path(path)
+    canvas_builder.set_size(layers.canvas_width, layers.canvas_height)
+    canvas = canvas_builder.build()
 
     # Finally, let's get to rendering stuff!
     polygon_drawer = PolygonDrawer()
     polygon_drawer.fill_color = land_color
-    polygon_drawer.geoms = [mask_canvas]
+    polygon_drawer.geoms = [layers.mask_canvas]
     polygon_drawer.draw(canvas)
 
     polygon_drawer = PolygonDrawer()
     polygon_drawer.fill_color = beach_color
-    polygon_drawer.geoms = [beaches_canvas]
+    polygon_drawer.geoms = [layers.beaches_canvas]
     polygon_drawer.draw(canvas)
 
-    shade_matrix = build_geotiff_crs_within_canvas_matrix(
-            # Add padding to avoid hill-shade edges appearing on map
-            rect(canvas_bbox).buffer(Cu.from_px(10).pt),
-            builder,
-            shade_tiff
-        )
     canvas.context.save()
-    canvas.context.transform(shade_matrix)
+    canvas.context.transform(layers.shade_matrix)
 
     bitmap = Bitmap(height_path)
     bitmap.draw(canvas)
 
-    for shade_path in glob.glob(hillshade_glob, root_dir=root_path):
-        svg_drawer = Svg(Path(shade_path))
-        svg_drawer.draw(canvas)
+    draw_shade_levels(
+        canvas,
+        overview_output_path,
+        overview_shade_levels,
+        dark
+    )
 
     canvas.context.restore()
 
     polygon_drawer = PolygonDrawer()
     polygon_drawer.fill_color = sea_color
-    polygon_drawer.geoms = [water_canvas]
+    polygon_drawer.geoms = [layers.water_canvas]
     polygon_drawer.draw(canvas)
 
     line_drawer = LineDrawer()
-    line_drawer.geoms = [boat_path_canvas]
+    line_drawer.geoms = [layers.boat_path_canvas]
     line_drawer.stroke_color = boat_path
     line_drawer.stroke_width = Cu.from_px(2)
     line_drawer.stroke_dashes = [Cu.from_px(2), Cu.from_px(3)], Cu.from_px(3)
@@ -199,11 +257,11 @@ def render(
     svg_actual_height = Cu.from_px(35)
     svg_drawer.width = Cu.from_px(50)
     svg_drawer.height = Cu.from_px(35)
-    boat_line_string_length = boat_path_canvas.length
-    boat_position: Point = boat_path_canvas.interpolate(
+    boat_line_string_length = layers.boat_path_canvas.length
+    boat_position: Point = layers.boat_path_canvas.interpolate(
         boat_line_string_length - svg_drawer.width.pt / 6
     )
-    boat_position_left: Point = boat_path_canvas.interpolate(
+    boat_position_left: Point = layers.boat_path_canvas.interpolate(
         boat_line_string_length
     )
     svg_drawer.position = CanvasCoordinate.from_pt(
@@ -222,8 +280,8 @@ def render(
 
     draw_annotation(
         canvas,
-        CanvasCoordinate.from_pt(*wgs84_to_canvas(
-            *GeoCoordinate(8.9020, -77.6733, wgs84_crs).tuple
+        CanvasCoordinate.from_pt(*layers.wgs84_to_canvas(
+            *GeoCoordinate(8.9020, -77.6733, layers.wgs84_crs).tuple
         )),
         'right',
         Cu.from_px(50),
@@ -234,8 +292,8 @@ def render(
 
     draw_annotation(
         canvas,
-        CanvasCoordinate.from_pt(*wgs84_to_canvas(
-            *GeoCoordinate(8.8401, -77.6390, wgs84_crs).tuple
+        CanvasCoordinate.from_pt(*layers.wgs84_to_canvas(
+            *GeoCoordinate(8.8401, -77.6390, layers.wgs84_crs).tuple
         )),
         'up',
         (Cu.from_px(-30), Cu.from_px(-95)),
@@ -248,8 +306,8 @@ def render(
 
     draw_annotation(
         canvas,
-        CanvasCoordinate.from_pt(*wgs84_to_canvas(
-            *GeoCoordinate(8.8342, -77.6432, wgs84_crs).tuple
+        CanvasCoordinate.from_pt(*layers.wgs84_to_canvas(
+            *GeoCoordinate(8.8342, -77.6432, layers.wgs84_crs).tuple
         )),
         'up',
         (Cu.from_px(-45), Cu.from_px(-190)),
@@ -262,8 +320,8 @@ def render(
 
     draw_map_scale(
         canvas,
-        canvas_bbox,
-        builder,
+        layers.canvas_bbox,
+        layers.builder,
         2000,  # 2 km
         4,
         [
@@ -276,5 +334,35 @@ def render(
     canvas.close()
 
 
+@click.command()
+@click.option(
+    "--dark/--light",
+    default=False,
+    help='Disables anti-aliasing when rendering the image.'
+)
+@click.option(
+    "--all-themes",
+    is_flag=True,
+    default=False,
+    help='Renders both the light and dark themes, sharing the geometry.'
+)
+@click.option(
+    "--simplify-tolerance",
+    type=float,
+    default=0.25,
+    help='Simplifies the geometry before drawing, dropping details smaller '
+         'than about this many pixels. See `simplify_layers`. Set to 0 to '
+         'draw the geometry at full resolution.'
+)
+def render(
+        dark: bool,
+        all_themes: bool,
+        simplify_tolerance: float
+):
+    layers = prepare(simplify_tolerance)
+    for theme_dark in ([False, True] if all_themes else [dark]):
+        draw(layers, theme_dark)
+
+
 if __name__ == '__main__':
     render()
@@ -1,24 +1,19 @@
-import glob
-
 import math
 from pathlib import Path
-from typing import List
+from typing import Callable, NamedTuple
 
 import cairocffi.constants
 import click
-import shapefile
 from map_engraver.data.canvas_geometry.rect import rect
 from map_engraver.data.geo_canvas_ops.geo_canvas_mask import \
     canvas_mask, canvas_wgs84_mask
 from map_engraver.data.geo_canvas_ops.geo_canvas_transformers_builder import \
     GeoCanvasTransformersBuilder
-from map_engraver.data.osm import Parser
-from map_engraver.data.osm.filter import filter_elements
 from map_engraver.data.osm_shapely.osm_to_shapely import OsmToShapely
 from map_engraver.drawable.geometry.line_drawer import LineDrawer
 from map_engraver.drawable.images.svg import Svg
 from pangocffi import Alignment
-from shapely.geometry import shape, MultiLineString, Point
+from shapely.geometry import MultiLineString, Point
 from shapely.geometry.base import BaseGeometry
 
 from pyproj import CRS
@@ -28,42 +23,39 @@ from map_engraver.canvas import CanvasBuilder
 from map_engraver.canvas.canvas_coordinate import CanvasCoordinate
 from map_engraver.canvas.canvas_unit import CanvasUnit as Cu
 from map_engraver.data.geo.geo_coordinate import GeoCoordinate
-from map_engraver.data.osm_shapely_ops.transform import \
-    transform_interpolated_euclidean
-
 from map_engraver.drawable.geometry.polygon_drawer import PolygonDrawer
 
 from new_caledonia_maps.annotation import draw_annotation_with_flag
-
-
-@click.command()
-@click.option(
-    "--dark/--light",
-    default=False,
-    help='Disables anti-aliasing when rendering the image.'
-)
-def render(
-        dark: bool,
-):
-    name = 'panama-light.svg'
-
-    img_path = Path(__file__).parent.parent.joinpath('img')
-
-    sea_color = (0/255, 101/255, 204/255)
-    land_color = (183/255, 218/255, 158/255)
-    boat_path_color = (255 / 255, 255 / 255, 255 / 255)
-    ship_side_path = img_path.joinpath('ship_side_light.svg')
-    panama_border_color = (0, 0, 0)
-    shade_glob = 'data/panama_shaded_relief/light_*.svg'
-    if dark:
-        name = 'panama-dark.svg'
-        sea_color = (0 / 255, 36 / 255, 125 / 255)
-        land_color = (76 / 255, 141 / 255, 146 / 255)
-        boat_path_color = (184 / 255, 204 / 255, 255 / 255)
-        ship_side_path = img_path.joinpath('ship_side_dark.svg')
-        panama_border_color = (1, 1, 1)
-        shade_glob = 'data/panama_shaded_relief/dark_*.svg'
-
+from new_caledonia_maps.geometry import difference_by_parts, \
+    intersection_by_parts, simplify_layers
+from new_caledonia_maps.natural_earth import parse_shapefile
+from new_caledonia_maps.osm_data import OsmTagIndex, parse_osm
+from new_caledonia_maps.projection import project_to_canvas
+from new_caledonia_maps.shade_layer import draw_shade_levels
+from new_caledonia_maps.shade_levels import panama_output_path, \
+    panama_shade_levels
+
+
+class PanamaLayers(NamedTuple):
+    canvas_width: Cu
+    canvas_height: Cu
+    wgs84_crs: CRS
+    wgs84_to_canvas: Callable
+    mask_canvas: BaseGeometry
+    land_shapes_canvas: BaseGeometry
+    boat_path_canvas: BaseGeometry
+    panama_border_canvas: BaseGeometry
+
+
+def prepare(simplify_tolerance: float = 0.25) -> PanamaLayers:
+    """
+    Computes all the theme-independent geometry of the Panama map, already
+    projected onto the canvas.
+
+    :param simplify_tolerance: The tolerance, in pixels, that the projected
+                               layers are simplified to before drawing.
+    :return:
+    """
     # Extract shapefile data into multi-polygons
     root_path = Path(__file__).parent.parent
     data_path = root_path.joinpath('data')
@@ -71,102 +63,39 @@ def render(
     lake_shape_path = data_path.joinpath('ne_10m_lakes/ne_10m_lakes.shp')
     borders_path = data_path.joinpath('borders.osm')
 
-    # Read land/lake map shapefile data
-    def parse_shapefile(shapefile_path: Path):
-        shapefile_collection = shapefile.Reader(shapefile_path.as_posix())
-        shapely_objects = []
-        for shape_record in shapefile_collection.shapeRecords():
-            shapely_objects.append(shape(shape_record.shape.__geo_interface__))
-        return shapely_objects
-
-    land_shapes = parse_shapefile(land_shape_path)
-    lake_shapes = parse_shapefile(lake_shape_path)
-
     # Read borders data
-    osm_map = Parser.parse(borders_path)
+    osm_map = parse_osm(borders_path)
     osm_to_shapely = OsmToShapely(osm_map)
-    panama_border_ways = filter_elements(
-        osm_map,
-        lambda _, way: (
-                'barrier' in way.tags and
-                way.tags['barrier'] == 'border_control' and
-                'name' in way.tags and
-                way.tags['name'] == 'Panama'
-        ),
-        filter_nodes=False,
-        filter_relations=False
-    )
-    historic_water = filter_elements(
-        osm_map,
-        lambda _, way: (
-                'natural' in way.tags and way.tags['natural'] == 'water'
-        ),
-        filter_nodes=False,
-        filter_relations=False
-    )
-    historic_land = filter_elements(
-        osm_map,
-        lambda _, way: (
-                'natural' in way.tags and way.tags['natural'] == 'land'
-        ),
-        filter_nodes=False,
-        filter_relations=False
-    )
+    osm_index = OsmTagIndex(osm_map)
     panama_border_wgs84 = list(map(
         lambda way: osm_to_shapely.way_to_line_string(way),
-        list(panama_border_ways.ways.values())
+        filter(
+            lambda way: way.tags.get('barrier') == 'border_control',
+            osm_index.ways('name', 'Panama')
+        )
     ))
     polygons_water = list(map(
         lambda way: osm_to_shapely.way_to_polygon(way),
-        list(historic_water.ways.values())
+        osm_index.ways('natural', 'water')
     ))
     polygons_land = list(map(
         lambda way: osm_to_shapely.way_to_polygon(way),
-        list(historic_land.ways.values())
+        osm_index.ways('natural', 'land')
     ))
 
-    # Invert CRS for shapes, because shapefiles are store coordinates are
-    # lon/lat, not according to the ISO-approved standard.
-    def transform_geoms_to_invert(geoms: List[BaseGeometry]):
-        return list(map(
-            lambda geom: ops.transform(lambda x, y: (y, x), geom),
-            geoms
-        ))
-
-    land_shapes = transform_geoms_to_invert(land_shapes)
-    lake_shapes = transform_geoms_to_invert(lake_shapes)
-    land_shapes = ops.unary_union(land_shapes + polygons_land)
-    # Add ancient lakes
-    lake_shapes = ops.unary_union(lake_shapes + polygons_water)
-    # Removed modern lakes and reservoirs
-    lake_shapes = lake_shapes.difference(ops.unary_union(polygons_land))
-
     # Read boat route.
-    boat_way = filter_elements(
-        osm_map, lambda _, way: (
-            'name' in way.tags and way.tags['name'] == 'First Expedition'
-        ),
-        filter_nodes=False,
-        filter_relations=False
-    )
     boat_path_wgs84 = osm_to_shapely.way_to_line_string(
-        list(boat_way.ways.values())[0]
+        osm_index.ways('name', 'First Expedition')[0]
     )
 
-    # Build the canvas
-    Path(__file__).parent.parent.joinpath('output/') \
-        .mkdir(parents=True, exist_ok=True)
-    path = Path(__file__).parent.parent.joinpath('output/%s' % name)
-    path.unlink(missing_ok=True)
+    # Build the canvas bounds
     canvas_builder = CanvasBuilder()
-    canvas_builder.set_path(path)
     canvas_width = Cu.from_px(720)
     canvas_height = Cu.from_px(500)
     canvas_builder.set_size(
         canvas_width,
         canvas_height
     )
-    canvas = canvas_builder.build()
     canvas_bbox = canvas_builder.build_bbox()
 
     # Now let's sort out the projection system
@@ -195,39 +124,119 @@ def render(
         builder
     )
 
+    # Read land/lake map shapefile data. Shapefiles store coordinates as
+    # lon/lat, not according to the ISO-approved standard, so we invert them.
+    # Only records that overlap the map are read, so we don't have to union
+    # the land and lakes of the entire planet.
+    land_shapes = parse_shapefile(
+        land_shape_path,
+        lat_lon_order=True,
+        bbox=mask_wgs84.bounds
+    )
+    lake_shapes = parse_shapefile(
+        lake_shape_path,
+        lat_lon_order=True,
+        bbox=mask_wgs84.bounds
+    )
+
+    land_shapes = ops.unary_union(land_shapes + polygons_land)
+    # Add ancient lakes
+    lake_shapes = ops.unary_union(lake_shapes + polygons_water)
+    # Removed modern lakes and reservoirs
+    lake_shapes = lake_shapes.difference(ops.unary_union(polygons_land))
+
     # Cull away unnecessary geometries, and subtract lakes from land.
-    land_shapes = land_shapes.intersection(mask_wgs84)
-    lake_shapes = lake_shapes.intersection(mask_wgs84)
-    land_shapes = land_shapes.difference(lake_shapes)
+    land_shapes = intersection_by_parts(land_shapes, mask_wgs84)
+    lake_shapes = intersection_by_parts(lake_shapes, mask_wgs84)
+    land_shapes = difference_by_parts(land_shapes, lake_shapes)
+
+    # Project everything onto the canvas
+    land_shapes_canvas = project_to_canvas(
+        builder,
+        land_shapes,
+        disk_cache=True
+    )
+
+    boat_path_canvas = project_to_canvas(
+        builder, boat_path_wgs84, disk_cache=True
+    )
+    boat_path_canvas = boat_path_canvas.intersection(mask_canvas)
+
+    panama_border_canvas = project_to_canvas(
+        builder, MultiLineString(panama_border_wgs84), disk_cache=True
+    )
+    panama_border_canvas = panama_border_canvas.simplify(1)
+
+    land_shapes_canvas, boat_path_canvas = simplify_layers(
+        [land_shapes_canvas, boat_path_canvas],
+        Cu.from_px(simplify_tolerance).pt
+    )
+
+    return PanamaLayers(
+        canvas_width=canvas_width,
+        canvas_height=canvas_height,
+        wgs84_crs=wgs84_crs,
+        wgs84_to_canvas=wgs84_to_canvas,
+        mask_canvas=mask_canvas,
+        land_shapes_canvas=land_shapes_canvas,
+        boat_path_canvas=boat_path_canvas,
+        panama_border_canvas=panama_border_canvas
+    )
+
+
+def draw(layers: PanamaLayers, dark: bool):
+    """
+    Draws the Panama map using either the light or dark theme.
+    """
+    name = 'panama-light.svg'
+
+    root_path = Path(__file__).parent.parent
+    img_path = root_path.joinpath('img')
+
+    sea_color = (0/255, 101/255, 204/255)
+    land_color = (183/255, 218/255, 158/255)
+    boat_path_color = (255 / 255, 255 / 255, 255 / 255)
+    ship_side_path = img_path.joinpath('ship_side_light.svg')
+    panama_border_color = (0, 0, 0)
+    if dark:
+        name = 'panama-dark.svg'
+        sea_color = (0 / 255, 36 / 255, 125 / 255)
+        land_color = (76 / 255, 141 / 255, 146 / 255)
+        boat_path_color = (184 / 255, 204 / 255, 255 / 255)
+        ship_side_path = img_path.joinpath('ship_side_dark.svg')
+        panama_border_color = (1, 1, 1)
+
+    # Build the canvas
+    Path(__file__).parent.parent.joinpath('output/') \
+        .mkdir(parents=True, exist_ok=True)
+    path = Path(__file__).parent.parent.joinpath('output/%s' % name)
+    path.unlink(missing_ok=True)
+    canvas_builder = CanvasBuilder()
+    canvas_builder.set_path(path)
+    canvas_builder.set_size(layers.canvas_width, layers.canvas_height)
+    canvas = canvas_builder.build()
 
     # Finally, let's get to rendering stuff!
     polygon_drawer = PolygonDrawer()
     polygon_drawer.fill_color = sea_color
-    polygon_drawer.geoms = [mask_canvas]
+    polygon_drawer.geoms = [layers.mask_canvas]
     polygon_drawer.draw(canvas)
 
-    land_shapes_canvas = transform_interpolated_euclidean(
-        wgs84_to_canvas,
-        land_shapes
-    )
-
     polygon_drawer = PolygonDrawer()
     polygon_drawer.fill_color = land_color
-    polygon_drawer.geoms = [land_shapes_canvas]
+    polygon_drawer.geoms = [layers.land_shapes_canvas]
     polygon_drawer.draw(canvas)
 
-    for shade_path in glob.glob(shade_glob, root_dir=root_path):
-        svg_drawer = Svg(Path(shade_path))
-        svg_drawer.width = canvas_width
-        svg_drawer.position = CanvasCoordinate.origin()
-        svg_drawer.draw(canvas)
-
-    boat_path_canvas = transform_interpolated_euclidean(
-        wgs84_to_canvas, boat_path_wgs84
+    draw_shade_levels(
+        canvas,
+        panama_output_path,
+        panama_shade_levels,
+        dark,
+        layers.canvas_width
     )
-    boat_path_canvas = boat_path_canvas.intersection(mask_canvas)
+
     line_drawer = LineDrawer()
-    line_drawer.geoms = [boat_path_canvas]
+    line_drawer.geoms = [layers.boat_path_canvas]
     line_drawer.stroke_color = boat_path_color
     line_drawer.stroke_width = Cu.from_px(2)
     line_drawer.stroke_dashes = [Cu.from_px(2), Cu.from_px(3)], Cu.from_px(3)
@@ -240,11 +249,11 @@ def render(
     svg_actual_height = Cu.from_px(35)
     svg_drawer.width = Cu.from_px(50)
     svg_drawer.height = Cu.from_px(35)
-    boat_line_string_length = boat_path_canvas.length
-    boat_position: Point = boat_path_canvas.interpolate(
+    boat_line_string_length = layers.boat_path_canvas.length
+    boat_position: Point = layers.boat_path_canvas.interpolate(
         boat_line_string_length - svg_drawer.width.pt / 5
     )
-    boat_position_left: Point = boat_path_canvas.interpolate(
+    boat_position_left: Point = layers.boat_path_canvas.interpolate(
         boat_line_string_length
     )
     svg_drawer.position = CanvasCoordinate.from_pt(
@@ -262,12 +271,8 @@ def render(
     svg_drawer.draw(canvas)
 
     # Draw the borders of Panama
-    panama_border_canvas = transform_interpolated_euclidean(
-        wgs84_to_canvas, MultiLineString(panama_border_wgs84)
-    )
-    panama_border_canvas = panama_border_canvas.simplify(1)
     line_drawer = LineDrawer()
-    line_drawer.geoms = [panama_border_canvas]
+    line_drawer.geoms = [layers.panama_border_canvas]
     line_drawer.stroke_color = panama_border_color
     line_drawer.stroke_width = Cu.from_px(2)
     line_drawer.stroke_dashes = [Cu.from_px(2), Cu.from_px(3)], Cu.from_px(3)
@@ -277,8 +282,8 @@ def render(
 
     draw_annotation_with_flag(
         canvas,
-        CanvasCoordinate.from_pt(*wgs84_to_canvas(
-            *GeoCoordinate(8.834019, -77.631797, wgs84_crs).tuple
+        CanvasCoordinate.from_pt(*layers.wgs84_to_canvas(
+            *GeoCoordinate(8.834019, -77.631797, layers.wgs84_crs).tuple
         )),
         'up',
         Cu.from_px(100),
@@ -289,8 +294,8 @@ def render(
 
     draw_annotation_with_flag(
         canvas,
-        CanvasCoordinate.from_pt(*wgs84_to_canvas(
-            *GeoCoordinate(9.582889, -79.470306, wgs84_crs).tuple
+        CanvasCoordinate.from_pt(*layers.wgs84_to_canvas(
+            *GeoCoordinate(9.582889, -79.470306, layers.wgs84_crs).tuple
         )),
         'up',
         Cu.from_px(110),
@@ -301,8 +306,8 @@ def render(
 
     draw_annotation_with_flag(
         canvas,
-        CanvasCoordinate.from_pt(*wgs84_to_canvas(
-            *GeoCoordinate(8.983333, -79.516667, wgs84_crs).tuple
+        CanvasCoordinate.from_pt(*layers.wgs84_to_canvas(
+            *GeoCoordinate(8.983333, -79.516667, layers.wgs84_crs).tuple
         )),
         'down',
         Cu.from_px(100),
@@ -313,8 +318,8 @@ def render(
 
     draw_annotation_with_flag(
         canvas,
-        CanvasCoordinate.from_pt(*wgs84_to_canvas(
-            *GeoCoordinate(9.554444, -79.655, wgs84_crs).tuple
+        CanvasCoordinate.from_pt(*layers.wgs84_to_canvas(
+            *GeoCoordinate(9.554444, -79.655, layers.wgs84_crs).tuple
         )),
         'up',
         Cu.from_px(80),
@@ -325,8 +330,8 @@ def render(
 
     draw_annotation_with_flag(
         canvas,
-        CanvasCoordinate.from_pt(*wgs84_to_canvas(
-            *GeoCoordinate(8.433333, -82.433333, wgs84_crs).tuple
+        CanvasCoordinate.from_pt(*layers.wgs84_to_canvas(
+            *GeoCoordinate(8.433333, -82.433333, layers.wgs84_crs).tuple
         )),
         'down',
         Cu.from_px(100),
@@ -337,8 +342,8 @@ def render(
 
     draw_annotation_with_flag(
         canvas,
-        CanvasCoordinate.from_pt(*wgs84_to_canvas(
-            *GeoCoordinate(9.5683, -82.5643, wgs84_crs).tuple
+        CanvasCoordinate.from_pt(*layers.wgs84_to_canvas(
+            *GeoCoordinate(9.5683, -82.5643, layers.wgs84_crs).tuple
         )),
         'up',
         Cu.from_px(50),
@@ -351,5 +356,35 @@ def render(
     canvas.close()
 
 
+@click.command()
+@click.option(
+    "--dark/--light",
+    default=False,
+    help='Disables anti-aliasing when rendering the image.'
+)
+@click.option(
+    "--all-themes",
+    is_flag=True,
+    default=False,
+    help='Renders both the light and dark themes, sharing the geometry.'
+)
+@click.option(
+    "--simplify-tolerance",
+    type=float,
+    default=0.25,
+    help='Simplifies the geometry before drawing, dropping details smaller '
+         'than about this many pixels. See `simplify_layers`. Set to 0 to '
+         'draw the geometry at full resolution.'
+)
+def render(
+        dark: bool,
+        all_themes: bool,
+        simplify_tolerance: float
+):
+    layers = prepare(simplify_tolerance)
+    for theme_dark in ([False, True] if all_themes else [dark]):
+        draw(layers, theme_dark)
+
+
 if __name__ == '__main__':
     render()
@@ -1,7 +1,7 @@
-import glob
-import subprocess
+from functools import partial
 from pathlib import Path
 
+import click
 from map_engraver.canvas.canvas_bbox import CanvasBbox
 from map_engraver.canvas.canvas_coordinate import CanvasCoordinate
 from map_engraver.canvas.canvas_unit import CanvasUnit as Cu
@@ -11,49 +11,36 @@ from map_engraver.data.geo_canvas_ops.geo_canvas_transformers_builder import \
     GeoCanvasTransformersBuilder
 from map_engraver.data.geotiff.canvas_transform import \
     transform_geotiff_to_crs_within_canvas
+from osgeo import gdal
 from pyproj import CRS
 
-
-def docker_run(command: str):
-    result = subprocess.call(
-        'docker run '
-        '--rm '
-        '-t '
-        '-v `pwd`:/root/mydata/ '
-        '-w /root/mydata/ '
-        'new-caledonia-maps-potrace '
-        '/bin/sh -c '
-        + "'" + command + "'",
-        shell=True,
-        cwd=Path(__file__).parent.parent.as_posix()
-    )
-    if result != 0:
-        raise Exception('Failed to execute docker command')
-
+from new_caledonia_maps.build_graph import BuildGraph
+from new_caledonia_maps.hillshade import add_shade_nodes, \
+    gdal_config_options, tracers
+from new_caledonia_maps.shade_levels import panama_filepath, \
+    panama_output_path, panama_shade_levels
 
 world_tif_filename = 'data/ne_10m_shaded_relief/SR_HR.tif'
-panama_filepath = 'data/panama_shaded_relief/'
 panama_tif_filename = panama_filepath + 'projected.tif'
-panama_pnm_filename = panama_filepath + 'projected.pnm'
-panama_svg_filename_match = panama_filepath + '*.svg'
-panama_svg_white_filename = panama_filepath + '%s_white_%.2f.svg'
-panama_svg_black_filename = panama_filepath + '%s_black_%.2f.svg'
-# In the world tif, flat slopes are this shade of gray.
-threshold_midpoint = 206 / 255
+
+# The view of the Panama map, which the hillshade is reprojected to.
+canvas_width_px = 720
+canvas_height_px = 500
+west_lat_lon = (9, -83.5)
+east_lat_lon = (9, -76.5)
 
 root_path = Path(__file__).parent.parent
 world_tif_path = root_path.joinpath(world_tif_filename)
-panama_output_path = root_path.joinpath(panama_filepath)
 panama_tif_path = root_path.joinpath(panama_tif_filename)
-panama_pnm_path = root_path.joinpath(panama_pnm_filename)
 
-# Generate the output directory if it doesn't exist.
-panama_output_path.mkdir(parents=True, exist_ok=True)
 
-# Reproject the world map hill-shade map from Natural Earth to a map of Panama.
-if not panama_tif_path.exists():
-    canvas_width = Cu.from_px(720)
-    canvas_height = Cu.from_px(500)
+def reproject_hillshade(source_path: Path, output_path: Path):
+    """
+    Reprojects the world map hill-shade map from Natural Earth to a map of
+    Panama.
+    """
+    canvas_width = Cu.from_px(canvas_width_px)
+    canvas_height = Cu.from_px(canvas_height_px)
     canvas_bbox = CanvasBbox(
         CanvasCoordinate.origin(),
         CanvasCoordinate(canvas_width, canvas_height)
@@ -64,87 +51,61 @@ if not panama_tif_path.exists():
     builder = GeoCanvasTransformersBuilder()
     builder.set_scale_and_origin_from_coordinates_and_crs(
         crs,
-        GeoCoordinate(9, -83.5, wgs84_crs),
-        GeoCoordinate(9, -76.5, wgs84_crs),
+        GeoCoordinate(west_lat_lon[0], west_lat_lon[1], wgs84_crs),
+        GeoCoordinate(east_lat_lon[0], east_lat_lon[1], wgs84_crs),
         CanvasCoordinate.from_px(0, canvas_height.px / 2),
         CanvasCoordinate.from_px(canvas_width.px, canvas_height.px / 2)
     )
     builder.set_data_crs(wgs84_crs)
 
-    transform_geotiff_to_crs_within_canvas(
-        world_tif_path,
-        canvas_rect,
-        builder,
-        panama_tif_path
-    )
+    with gdal.config_options(gdal_config_options):
+        transform_geotiff_to_crs_within_canvas(
+            source_path,
+            canvas_rect,
+            builder,
+            output_path
+        )
 
-# Convert the TIFF to PNM.
-if not panama_pnm_path.exists():
-    docker_run(
-        'tifftopnm %s > %s' % (panama_tif_filename, panama_pnm_filename)
-    )
 
-# Generate the **black** specs of the TIFF as an SVG at different brightness
-# thresholds. We duplicate them, so we can have dark and light themes later.
-for threshold_delta in [0.05, 0.10, 0.15]:
-    threshold = threshold_midpoint + threshold_delta
-    docker_run(
-        'potrace %s -o %s -b svg -k %f -i' % (
-            panama_pnm_filename,
-            panama_svg_white_filename % ('dark', threshold),
-            threshold
+def add_nodes(graph: BuildGraph, tracer_name: str = 'builtin'):
+    """
+    Adds the steps that build the hillshade graphics of the Panama map.
+    """
+    graph.add(
+        'panama-hillshade',
+        partial(reproject_hillshade, world_tif_path, panama_tif_path),
+        inputs=[world_tif_path],
+        outputs=[panama_tif_path],
+        params=(
+            canvas_width_px,
+            canvas_height_px,
+            west_lat_lon,
+            east_lat_lon
         )
     )
-    docker_run(
-        'cp %s %s' % (
-                panama_svg_white_filename % ('dark', threshold),
-                panama_svg_white_filename % ('light', threshold)
-        )
+    add_shade_nodes(
+        graph,
+        'panama',
+        panama_output_path,
+        panama_tif_path,
+        panama_shade_levels,
+        tracer_name
     )
 
-# Generate the **white** specs of the TIFF as an SVG at different brightness
-# thresholds. We duplicate them, so we can have dark and light themes later.
-for threshold_delta in [0.05, 0.10, 0.15, 0.25, 0.40]:
-    threshold = threshold_midpoint - threshold_delta
-    docker_run(
-        'potrace %s -o %s -b svg -k %f' % (
-            panama_pnm_filename,
-            panama_svg_black_filename % ('dark', threshold),
-            threshold
-        )
-    )
-    docker_run(
-        'cp %s %s' % (
-            panama_svg_black_filename % ('dark', threshold),
-            panama_svg_black_filename % ('light', threshold)
-        )
-    )
 
-# Update the colors of the SVGs according to the theme and colors.
-for path in glob.glob(panama_svg_filename_match, root_dir=root_path):
-    color = None
-    opacity = None
-    if 'dark' in path:
-        if 'black' in path:
-            color = '#000'
-            opacity = 0.1
-        else:
-            color = '#FFF'
-            opacity = 0.1
-    else:
-        if 'black' in path:
-            color = '#000'
-            opacity = 0.1
-        else:
-            color = '#FFF'
-            opacity = 0.2
+@click.command()
+@click.option(
+    "--tracer",
+    "tracer_name",
+    type=click.Choice(tracers),
+    default='builtin',
+    help='Traces the hillshade in-process, or with potrace in docker.'
+)
+def build(tracer_name: str):
+    build_graph = BuildGraph()
+    add_nodes(build_graph, tracer_name)
+    build_graph.run()
 
-    docker_run(
-        'sed -i -e "s/fill=\\"#000000\\"/fill=\\"%s\\" opacity=\\"%f\\"/" %s'
-        % (
-            color, opacity, path
-        )
-    )
-    docker_run(
-        'sed -i -e "s/pt\\"/px\\"/g" %s' % path
-    )
+
+if __name__ == '__main__':
+    build()
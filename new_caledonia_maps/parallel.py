@@ -0,0 +1,40 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Iterable, List
+
+# Set in the workers of a pool that already uses every CPU, so that the
+# maps they run do not start nested pools and oversubscribe the CPUs.
+_serial = False
+
+
+def run_serially():
+    """
+    Makes `thread_map` and `process_map` run in the calling process, one
+    item at a time. Call it from the initializer of a pool's workers.
+    """
+    global _serial
+    _serial = True
+
+
+def thread_map(func: Callable, items: Iterable) -> List:
+    """
+    Applies `func` to each item on a thread pool and returns the results in
+    order. Only useful for work that releases the GIL, such as Shapely/GEOS
+    operations, GDAL calls or subprocesses.
+    """
+    if _serial:
+        return list(map(func, items))
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        return list(executor.map(func, items))
+
+
+def process_map(func: Callable, items: Iterable) -> List:
+    """
+    Applies `func` to each item on a process pool and returns the results in
+    order. `func` and the items must be picklable, so `func` should be a
+    module-level function (optionally wrapped in `functools.partial`).
+    """
+    if _serial:
+        return list(map(func, items))
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        return list(executor.map(func, items))
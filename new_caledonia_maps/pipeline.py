@@ -0,0 +1,234 @@
+import ast
+import os
+import subprocess
+import sys
+import threading
+from functools import partial
+from pathlib import Path
+from typing import List, Optional, Set, Tuple
+
+import click
+
+from new_caledonia_maps import overview_hillshade, panama_hillshade, \
+    preview_hillshade
+from new_caledonia_maps.build_graph import BuildGraph
+from new_caledonia_maps.hillshade import engines, tracers
+
+root_path = Path(__file__).parent.parent
+data_path = root_path.joinpath('data')
+output_path = root_path.joinpath('output')
+img_path = root_path.joinpath('img')
+script_path = Path(__file__).parent
+
+# The CPUs each render uses. Most renders use one, so they run alongside
+# each other, but the world map projects its layers on a process pool of
+# its own, so it waits for every CPU and runs alone.
+render_cpus = {'world': os.cpu_count() or 1}
+_free_cpus = os.cpu_count() or 1
+_cpus_freed = threading.Condition()
+
+
+def local_modules(module_path: Path) -> Set[Path]:
+    """
+    Finds the modules of this package that a script imports, directly or
+    through other modules, including the script itself.
+    """
+    found = set()
+    queue = [module_path]
+    while len(queue) > 0:
+        path = queue.pop()
+        if path in found:
+            continue
+        found.add(path)
+        for statement in ast.walk(ast.parse(path.read_text())):
+            if not isinstance(statement, ast.ImportFrom) or \
+                    statement.module is None or \
+                    not statement.module.startswith(script_path.name):
+                continue
+            if statement.module == script_path.name:
+                names = [alias.name for alias in statement.names]
+            else:
+                names = [statement.module.split('.')[-1]]
+            queue.extend(
+                script_path.joinpath('%s.py' % name) for name in names
+            )
+    return found
+
+
+def render_map(name: str):
+    global _free_cpus
+    cpus = render_cpus.get(name, 1)
+    with _cpus_freed:
+        _cpus_freed.wait_for(lambda: _free_cpus >= cpus)
+        _free_cpus -= cpus
+    try:
+        _render_map(name)
+    finally:
+        with _cpus_freed:
+            _free_cpus += cpus
+            _cpus_freed.notify_all()
+
+
+def _render_map(name: str):
+    subprocess.check_call(
+        [
+            sys.executable,
+            script_path.joinpath('%s.py' % name).as_posix(),
+            '--all-themes'
+        ],
+        cwd=root_path.as_posix()
+    )
+
+
+def add_render_node(
+        graph: BuildGraph,
+        name: str,
+        data_inputs: List[Path],
+        hillshade_prefix: Optional[str] = None
+):
+    """
+    Adds the step that renders the light and dark themes of a map.
+
+    :param graph:
+    :param name: The name of the map's script, such as 'preview'.
+    :param data_inputs: The source data the map reads. The map's script, the
+                        modules it imports and the images are inputs too.
+    :param hillshade_prefix: If set, every file built by the steps with this
+                             prefix is an input of the map.
+    :return:
+    """
+    inputs = sorted(local_modules(script_path.joinpath('%s.py' % name)))
+    inputs += data_inputs + sorted(img_path.glob('*.svg'))
+    if hillshade_prefix is not None:
+        inputs += [
+            path
+            for node_name, node in list(graph.nodes.items())
+            if node_name.startswith(hillshade_prefix + '-')
+            for path in node.outputs
+        ]
+    graph.add(
+        'render-%s' % name,
+        partial(render_map, name),
+        inputs=inputs,
+        outputs=[
+            output_path.joinpath('%s-light.svg' % name),
+            output_path.joinpath('%s-dark.svg' % name)
+        ]
+    )
+
+
+def build_pipeline(
+        tracer_name: str = 'builtin',
+        engine: str = 'gdal'
+) -> BuildGraph:
+    """
+    Builds the graph of every step needed to produce all the maps, from the
+    hillshade graphics to the final renders.
+
+    :param tracer_name: How the hillshades are traced. See
+                        `hillshade.tracers`.
+    :param engine: How the reliefs and hillshades are computed. See
+                   `hillshade.engines`.
+    :return:
+    """
+    graph = BuildGraph()
+    preview_hillshade.add_nodes(graph, tracer_name, engine)
+    overview_hillshade.add_nodes(graph, tracer_name, engine)
+    panama_hillshade.add_nodes(graph, tracer_name)
+
+    add_render_node(
+        graph,
+        'preview',
+        [
+            data_path.joinpath('new_caledonia.osm'),
+            data_path.joinpath('preview.osm')
+        ],
+        'preview'
+    )
+    add_render_node(
+        graph,
+        'overview',
+        [
+            data_path.joinpath('new_caledonia.osm'),
+            data_path.joinpath('preview.osm')
+        ],
+        'overview'
+    )
+    add_render_node(
+        graph,
+        'world',
+        [
+            data_path.joinpath('ne_50m_land/ne_50m_land.shp'),
+            data_path.joinpath('ne_50m_lakes/ne_50m_lakes.shp'),
+            data_path.joinpath('borders.osm')
+        ]
+    )
+    add_render_node(
+        graph,
+        'panama',
+        [
+            data_path.joinpath('ne_10m_land/ne_10m_land.shp'),
+            data_path.joinpath('ne_10m_lakes/ne_10m_lakes.shp'),
+            data_path.joinpath('borders.osm')
+        ],
+        'panama'
+    )
+    return graph
+
+
+@click.command()
+@click.argument('targets', nargs=-1)
+@click.option(
+    "--force",
+    is_flag=True,
+    default=False,
+    help='Re-runs every step, even if it is up to date.'
+)
+@click.option(
+    "--jobs",
+    type=int,
+    default=None,
+    help='The number of steps to run at once. Defaults to the CPU count.'
+)
+@click.option(
+    "--tracer",
+    "tracer_name",
+    type=click.Choice(tracers),
+    default='builtin',
+    help='Traces the hillshades in-process, or with potrace in docker.'
+)
+@click.option(
+    "--engine",
+    type=click.Choice(engines),
+    default='gdal',
+    help='Computes the reliefs and hillshades with gdaldem, or with NumPy.'
+)
+@click.option(
+    "--list",
+    "list_steps",
+    is_flag=True,
+    default=False,
+    help='Lists the names of the steps instead of running them.'
+)
+def run(
+        targets: Tuple[str, ...],
+        force: bool,
+        jobs: Optional[int],
+        tracer_name: str,
+        engine: str,
+        list_steps: bool
+):
+    """
+    Brings the given steps (or every step) up to date, such as
+    `render-preview` or `panama-hillshade`.
+    """
+    graph = build_pipeline(tracer_name, engine)
+    if list_steps:
+        for name in graph.nodes.keys():
+            print(name)
+        return
+    graph.run(targets or None, force=force, jobs=jobs)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,318 @@
+import hashlib
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import numpy as np
+import shapely
+from map_engraver.data.geo_canvas_ops.geo_canvas_transformers_builder import \
+    GeoCanvasTransformersBuilder
+from map_engraver.data.osm_shapely_ops.transform import \
+    transform_interpolated_euclidean
+from shapely.geometry import GeometryCollection, LinearRing, LineString, \
+    MultiLineString, MultiPoint, MultiPolygon, Point, Polygon
+from pyproj import Transformer
+from pyproj.enums import TransformDirection
+from shapely.geometry.base import BaseGeometry
+
+from new_caledonia_maps.cache import cache_file, load_geoms, save_geoms
+
+# The number of projected geometries kept in memory by `project_to_canvas`.
+memory_cache_size = 32
+_memory_cache: 'OrderedDict[str, BaseGeometry]' = OrderedDict()
+# How far, in canvas units (pt), the fitted canvas step of
+# `fit_canvas_matrix` may miss the builder's own transformer.
+affine_tolerance = 1e-6
+
+
+def _format_numbers(*values: float) -> str:
+    return ' '.join('%.17g' % value for value in values)
+
+
+def builder_fingerprint(builder: GeoCanvasTransformersBuilder) -> str:
+    """
+    Returns a hash of the builder's settings: its CRS and data CRS, scale,
+    rotation and origins. Only the settings are read, so fingerprinting
+    never depends on, or fails on, the geometry being projected.
+
+    :param builder:
+    :return:
+    """
+    parts = [
+        builder.data_crs.to_wkt(),
+        builder.crs.to_wkt(),
+        _format_numbers(
+            builder.scale.geo_units,
+            builder.scale.canvas_units.pt,
+            builder.rotation
+        ),
+        _format_numbers(*builder.origin_for_canvas.pt),
+    ]
+    origin = builder.origin_for_geo
+    if origin is not None:
+        parts += [origin.crs.to_wkt(), _format_numbers(*origin.tuple)]
+    return hashlib.sha1('\0'.join(parts).encode()).hexdigest()
+
+
+def geometry_digest(geom: BaseGeometry) -> str:
+    """
+    Returns a hash of the geometry's coordinates.
+    """
+    return hashlib.sha1(shapely.to_wkb(geom)).hexdigest()
+
+
+def fit_canvas_matrix(
+        builder: GeoCanvasTransformersBuilder,
+        crs_transformer: Transformer
+) -> np.ndarray:
+    """
+    Fits the affine canvas step (scale, rotation and origin) of the builder
+    from its own transformer, at the builder's geographic origin. The fit is
+    checked against a fourth point, so a canvas step that is not affine
+    raises rather than silently misplacing geometry.
+
+    :return: A 3x2 matrix that maps `(x, y, 1)` in the builder's CRS to the
+             canvas.
+    """
+    origin = builder.origin_for_geo
+    if origin is None:
+        raise Exception('The builder has no origin to fit its canvas step at')
+    # Pick points in the projected CRS at the origin, map them back to the
+    # data CRS, and see where the builder puts them. The points are a
+    # kilometre apart, or 0.01 degrees, and step towards the centre of the
+    # projection, so that they stay on the globe even when the origin is
+    # near the horizon of an orthographic projection.
+    x, y = Transformer.from_crs(origin.crs, builder.crs).transform(
+        *origin.tuple
+    )
+    step = 0.01 if builder.crs.is_geographic else 1000
+    step_x = -step if x > 0 else step
+    step_y = -step if y > 0 else step
+    crs_points = np.array([
+        [x, y],
+        [x + step_x, y],
+        [x, y + step_y],
+        # Off the parallelogram of the first three, so that curvature along
+        # either axis shows up in the check.
+        [x + 2 * step_x, y + 3 * step_y]
+    ])
+    data_x, data_y = crs_transformer.transform(
+        crs_points[:, 0],
+        crs_points[:, 1],
+        direction=TransformDirection.INVERSE
+    )
+    canvas_points = _transform_coords(
+        builder.build_crs_to_canvas_transformer(),
+        np.column_stack([data_x, data_y])
+    )
+    if not np.all(np.isfinite(canvas_points)):
+        raise Exception(
+            'Cannot fit the canvas transform: the points sampled near the '
+            'origin (%g, %g) do not all project' % (x, y)
+        )
+    crs_points_1 = np.column_stack([crs_points, np.ones(len(crs_points))])
+    matrix = np.linalg.solve(crs_points_1[:3], canvas_points[:3])
+    residual = np.hypot(*(crs_points_1[3] @ matrix - canvas_points[3]))
+    if not residual <= affine_tolerance:
+        raise Exception(
+            'The canvas transform is not affine: it is off by %g pt at a '
+            'fourth point' % residual
+        )
+    return matrix
+
+
+def build_array_transformer(
+        builder: GeoCanvasTransformersBuilder
+) -> Callable[[np.ndarray], np.ndarray]:
+    """
+    Builds an array-native version of the builder's CRS to canvas
+    transformer. The returned function takes an `(n, 2)` array of
+    coordinates in the data CRS and returns the canvas coordinates, running
+    the pyproj transform and the canvas step on the whole array at once.
+
+    The canvas step (scale, rotation and origin) is affine, so it is fitted
+    from the builder's own transformer with `fit_canvas_matrix`, rather than
+    depending on how the builder stores it internally.
+
+    :param builder:
+    :return:
+    """
+    crs_transformer = Transformer.from_crs(builder.data_crs, builder.crs)
+    matrix = fit_canvas_matrix(builder, crs_transformer)
+
+    def to_canvas(coords: np.ndarray) -> np.ndarray:
+        if len(coords) == 0:
+            return coords
+        x, y = crs_transformer.transform(coords[:, 0], coords[:, 1])
+        return np.column_stack([x, y, np.ones(len(coords))]) @ matrix
+
+    return to_canvas
+
+
+def transform_to_canvas(
+        builder: GeoCanvasTransformersBuilder,
+        geom: BaseGeometry
+) -> BaseGeometry:
+    """
+    Projects a geometry onto the canvas without interpolating its edges,
+    like `shapely.ops.transform(builder.build_crs_to_canvas_transformer(),
+    geom)`, but with all coordinates transformed in a single vectorized
+    call.
+    """
+    return shapely.transform(geom, build_array_transformer(builder))
+
+
+def _transform_coords(
+        transformer: Callable,
+        coords: np.ndarray
+) -> np.ndarray:
+    x, y = transformer(coords[:, 0], coords[:, 1])
+    return np.column_stack([np.asarray(x, dtype=float),
+                            np.asarray(y, dtype=float)])
+
+
+def _densify_adaptive(
+        transformer: Callable,
+        coords: np.ndarray,
+        tolerance: float,
+        max_depth: int
+) -> np.ndarray:
+    """
+    Transforms a coordinate sequence, halving each segment until the
+    projected midpoint is within `tolerance` of the projected chord.
+    """
+    src = coords[:, :2]
+    dst = _transform_coords(transformer, src)
+    # Only segments that were split in the previous round need checking.
+    pending = np.ones(len(src) - 1, dtype=bool)
+    for _ in range(max_depth):
+        segments = np.nonzero(pending)[0]
+        if len(segments) == 0:
+            break
+        mid_src = (src[segments] + src[segments + 1]) / 2
+        mid_dst = _transform_coords(transformer, mid_src)
+        chord_dst = (dst[segments] + dst[segments + 1]) / 2
+        split = np.hypot(*(mid_dst - chord_dst).T) > tolerance
+        if not split.any():
+            break
+        split_segments = segments[split]
+        src = np.insert(src, split_segments + 1, mid_src[split], axis=0)
+        dst = np.insert(dst, split_segments + 1, mid_dst[split], axis=0)
+        was_split = np.zeros(len(pending), dtype=bool)
+        was_split[split_segments] = True
+        pending = np.repeat(was_split, np.where(was_split, 2, 1))
+    return dst
+
+
+def transform_adaptive(
+        transformer: Callable,
+        geom: BaseGeometry,
+        tolerance: float,
+        max_depth: int = 16
+) -> BaseGeometry:
+    """
+    Like `transform_interpolated_euclidean`, but only adds vertices where
+    the projection actually bends a segment. Each segment is subdivided
+    until its projected midpoint deviates from the projected straight line
+    by no more than `tolerance`, so vertex counts follow the curvature of the
+    projection at the output resolution rather than the length of the edges.
+
+    :param transformer: A function that takes arrays of x and y coordinates
+                        and returns the transformed arrays, such as the
+                        builder's CRS to canvas transformer.
+    :param geom:
+    :param tolerance: The maximum deviation, in the transformer's output
+                      units.
+    :param max_depth: The maximum number of times a segment is halved.
+    :return:
+    """
+    def line(coords) -> np.ndarray:
+        return _densify_adaptive(
+            transformer,
+            np.asarray(coords),
+            tolerance,
+            max_depth
+        )
+
+    if geom.is_empty:
+        return geom
+    if isinstance(geom, Point):
+        return Point(
+            _transform_coords(transformer, np.asarray(geom.coords))[0]
+        )
+    if isinstance(geom, LinearRing):
+        return LinearRing(line(geom.coords))
+    if isinstance(geom, LineString):
+        return LineString(line(geom.coords))
+    if isinstance(geom, Polygon):
+        return Polygon(
+            line(geom.exterior.coords),
+            [line(interior.coords) for interior in geom.interiors]
+        )
+    parts = [
+        transform_adaptive(transformer, part, tolerance, max_depth)
+        for part in geom.geoms
+    ]
+    if isinstance(geom, MultiPoint):
+        return MultiPoint(parts)
+    if isinstance(geom, MultiLineString):
+        return MultiLineString(parts)
+    if isinstance(geom, MultiPolygon):
+        return MultiPolygon(parts)
+    return GeometryCollection(parts)
+
+
+def project_to_canvas(
+        builder: GeoCanvasTransformersBuilder,
+        geom: BaseGeometry,
+        disk_cache: bool = False,
+        tolerance: Optional[float] = None
+) -> BaseGeometry:
+    """
+    Projects a geometry in the builder's data CRS onto the canvas,
+    interpolating long edges so they follow the projection.
+
+    Takes the builder rather than the transformer, so that it can be
+    pickled and sent to worker processes.
+
+    Results are memoized on the geometry and the builder's settings, so
+    projecting the same geometry for the same view again is free.
+
+    :param builder:
+    :param geom:
+    :param disk_cache: If true, results are also stored in the cache
+                       directory, so they survive between runs.
+    :param tolerance: If set, edges are densified adaptively with
+                      `transform_adaptive`, to this tolerance in canvas
+                      units (pt), instead of at fixed intervals.
+    :return:
+    """
+    key = '%s-%s-%r' % (
+        geometry_digest(geom),
+        builder_fingerprint(builder),
+        tolerance
+    )
+    if key in _memory_cache:
+        _memory_cache.move_to_end(key)
+        return _memory_cache[key]
+
+    path = cache_file('projection', key)
+    if disk_cache and path.exists():
+        geom_canvas = load_geoms(path)[0]
+    elif tolerance is not None:
+        geom_canvas = transform_adaptive(
+            builder.build_crs_to_canvas_transformer(),
+            geom,
+            tolerance
+        )
+    else:
+        geom_canvas = transform_interpolated_euclidean(
+            builder.build_crs_to_canvas_transformer(),
+            geom
+        )
+    if disk_cache and not path.exists():
+        save_geoms(path, [geom_canvas])
+
+    _memory_cache[key] = geom_canvas
+    if len(_memory_cache) > memory_cache_size:
+        _memory_cache.popitem(last=False)
+    return geom_canvas
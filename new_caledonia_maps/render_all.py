@@ -0,0 +1,116 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import click
+
+from new_caledonia_maps import overview, panama, preview, world
+from new_caledonia_maps.osm_data import loaded_osm_maps, parse_osm, \
+    share_osm_maps
+from new_caledonia_maps.parallel import run_serially
+
+# Each map module has a `prepare` function that computes its geometry, and a
+# `draw` function that renders it in a theme.
+maps = {
+    'preview': preview,
+    'overview': overview,
+    'world': world,
+    'panama': panama,
+}
+
+
+def load_shared_data():
+    """
+    Parses the OSM data that is read by more than one map, so that it can be
+    handed to every worker instead of each map loading it again.
+    """
+    data_path = Path(__file__).parent.parent.joinpath('data')
+    # Used by the preview and overview maps.
+    preview.parse_osm_data()
+    overview.parse_osm_data()
+    # Used by the world and Panama maps.
+    parse_osm(data_path.joinpath('borders.osm'))
+
+
+def init_worker(osm_maps: Dict[Path, object]):
+    """
+    Sets up a worker with the shared OSM data. The workers already use every
+    CPU between them, so the maps they render do not start pools of their
+    own.
+    """
+    share_osm_maps(osm_maps)
+    run_serially()
+
+
+def render_map(map_name: str, simplify_tolerance: float) -> str:
+    """
+    Renders the light and dark themes of one map, preparing its geometry once
+    for both.
+    """
+    module = maps[map_name]
+    layers = module.prepare(simplify_tolerance)
+    for dark in [False, True]:
+        module.draw(layers, dark)
+    return map_name
+
+
+@click.command()
+@click.option(
+    "--map",
+    "map_names",
+    type=click.Choice(list(maps.keys())),
+    multiple=True,
+    help='The maps to render. Defaults to every map.'
+)
+@click.option(
+    "--jobs",
+    type=int,
+    default=None,
+    help='The number of maps to render at once. Defaults to the CPU count.'
+)
+@click.option(
+    "--simplify-tolerance",
+    type=float,
+    default=0.25,
+    help='Simplifies the geometry before drawing, dropping details smaller '
+         'than about this many pixels. See `simplify_layers`. Set to 0 to '
+         'draw the geometry at full resolution.'
+)
+def render(
+        map_names: Tuple[str, ...],
+        jobs: Optional[int],
+        simplify_tolerance: float
+):
+    """
+    Renders the light and dark themes of every map on a process pool.
+    """
+    map_names = map_names or tuple(maps.keys())
+    load_shared_data()
+
+    failures = []
+    with ProcessPoolExecutor(
+            max_workers=jobs or os.cpu_count(),
+            initializer=init_worker,
+            initargs=(loaded_osm_maps(),)
+    ) as executor:
+        futures = {
+            executor.submit(render_map, map_name, simplify_tolerance):
+                map_name
+            for map_name in map_names
+        }
+        for future in as_completed(futures):
+            map_name = futures[future]
+            error = future.exception()
+            if error is not None:
+                print('failed:   %s (%s)' % (map_name, error))
+                failures.append(map_name)
+            else:
+                print('rendered: %s' % map_name)
+
+    if len(failures) > 0:
+        raise Exception('Failed to render %s' % ', '.join(failures))
+
+
+if __name__ == '__main__':
+    render()
@@ -0,0 +1,219 @@
+import re
+import xml.etree.ElementTree as ElementTree
+from functools import lru_cache
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+
+import cairocffi
+from map_engraver.canvas import Canvas
+from map_engraver.canvas.canvas_unit import CanvasUnit as Cu
+
+from new_caledonia_maps.shade_levels import ShadeLevel, traced_svg_path
+
+_svg_namespace = '{http://www.w3.org/2000/svg}'
+_path_token = re.compile(
+    r'[MmLlHhVvCcQqZz]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+)
+_transform_token = re.compile(r'(translate|scale)\(([^)]*)\)')
+# The number of coordinates taken by each path command.
+_command_sizes = {'M': 2, 'L': 2, 'H': 1, 'V': 1, 'C': 6, 'Q': 4, 'Z': 0}
+
+
+class ShadeLayer(NamedTuple):
+    """
+    The outlines of a traced shade level, without any color, so that the same
+    layer can be drawn in every theme.
+    """
+    width: float
+    height: float
+    # Maps the coordinates of the outlines to the SVG's user space.
+    matrix: cairocffi.Matrix
+    # Each operation is 'M', 'C' or 'Z', with absolute coordinates. Lines
+    # and quadratic curves are converted to cubic curves.
+    operations: List[Tuple[str, Tuple[float, ...]]]
+    even_odd: bool
+
+
+def _parse_length(value: str) -> float:
+    return float(re.match(r'[-+]?[\d.]+(?:[eE][-+]?\d+)?', value).group())
+
+
+def _parse_transform(value: Optional[str]) -> cairocffi.Matrix:
+    matrix = cairocffi.Matrix()
+    for name, args in _transform_token.findall(value or ''):
+        numbers = [float(arg) for arg in re.split(r'[\s,]+', args.strip())]
+        if name == 'translate':
+            step = cairocffi.Matrix(x0=numbers[0], y0=(numbers + [0])[1])
+        else:
+            step = cairocffi.Matrix(numbers[0], 0, 0, (numbers * 2)[1])
+        # SVG applies the rightmost transform first.
+        matrix = step.multiply(matrix)
+    return matrix
+
+
+def _parse_path_data(data: str) -> List[Tuple[str, Tuple[float, ...]]]:
+    """
+    Parses the path data written by potrace or `tracer.write_svg`, which only
+    use moves, lines, cubic and quadratic curves, and closes.
+    """
+    tokens = _path_token.findall(data)
+    operations = []
+    x, y = 0, 0
+    start_x, start_y = 0, 0
+    command = None
+    index = 0
+    while index < len(tokens):
+        if tokens[index].isalpha():
+            command = tokens[index]
+            index += 1
+        if command is None:
+            raise Exception('Path data must start with a command')
+        upper = command.upper()
+        size = _command_sizes[upper]
+        args = [float(token) for token in tokens[index:index + size]]
+        index += size
+        # Relative coordinates are offset from the current point.
+        if command.islower():
+            if upper == 'H':
+                args = [args[0] + x]
+            elif upper == 'V':
+                args = [args[0] + y]
+            else:
+                args = [
+                    arg + (x if i % 2 == 0 else y)
+                    for i, arg in enumerate(args)
+                ]
+
+        if upper == 'M':
+            x, y = start_x, start_y = args
+            operations.append(('M', (x, y)))
+            # Further coordinate pairs after a move are lines.
+            command = 'l' if command == 'm' else 'L'
+        elif upper == 'Z':
+            x, y = start_x, start_y
+            operations.append(('Z', ()))
+        else:
+            if upper == 'H':
+                args = [args[0], y]
+            elif upper == 'V':
+                args = [x, args[0]]
+            if upper in ('L', 'H', 'V'):
+                args = [x, y, args[0], args[1], args[0], args[1]]
+            elif upper == 'Q':
+                # Raise the quadratic curve to a cubic curve.
+                cx, cy, end_x, end_y = args
+                args = [
+                    x + (cx - x) * 2 / 3,
+                    y + (cy - y) * 2 / 3,
+                    end_x + (cx - end_x) * 2 / 3,
+                    end_y + (cy - end_y) * 2 / 3,
+                    end_x,
+                    end_y
+                ]
+            x, y = args[4], args[5]
+            operations.append(('C', tuple(args)))
+    return operations
+
+
+@lru_cache(maxsize=None)
+def load_shade_layer(svg_path: Path) -> ShadeLayer:
+    """
+    Reads the outlines of a traced shade level. Layers are cached, so each
+    file is only parsed once however many themes are drawn.
+    """
+    root = ElementTree.parse(svg_path).getroot()
+    operations = []
+    matrix = cairocffi.Matrix()
+    even_odd = False
+    for group in root.iter(_svg_namespace + 'g'):
+        matrix = _parse_transform(group.get('transform'))
+        for path in group.iter(_svg_namespace + 'path'):
+            operations += _parse_path_data(path.get('d', ''))
+            even_odd = even_odd or path.get('fill-rule') == 'evenodd'
+    return ShadeLayer(
+        width=_parse_length(root.get('width')),
+        height=_parse_length(root.get('height')),
+        matrix=matrix,
+        operations=operations,
+        even_odd=even_odd
+    )
+
+
+def _parse_color(color: str) -> Tuple[float, float, float]:
+    digits = color.lstrip('#')
+    if len(digits) == 3:
+        digits = ''.join(digit * 2 for digit in digits)
+    return (
+        int(digits[0:2], 16) / 255,
+        int(digits[2:4], 16) / 255,
+        int(digits[4:6], 16) / 255
+    )
+
+
+def draw_shade_layer(
+        canvas: Canvas,
+        layer: ShadeLayer,
+        color: str,
+        opacity: float,
+        width: Optional[Cu] = None
+):
+    """
+    Fills the outlines of a shade layer at the canvas' current origin.
+
+    :param canvas:
+    :param layer:
+    :param color: A hex color, such as '#FFF'.
+    :param opacity:
+    :param width: The width to draw the layer at. Defaults to one pixel per
+                  unit of the layer, like drawing its SVG with `Svg`.
+    :return:
+    """
+    scale = Cu.from_px(1).pt if width is None else width.pt / layer.width
+    context = canvas.context
+    context.save()
+    context.scale(scale, scale)
+    context.transform(layer.matrix)
+    context.new_path()
+    for operation, args in layer.operations:
+        if operation == 'M':
+            context.move_to(*args)
+        elif operation == 'C':
+            context.curve_to(*args)
+        else:
+            context.close_path()
+    context.set_fill_rule(
+        cairocffi.FILL_RULE_EVEN_ODD
+        if layer.even_odd
+        else cairocffi.FILL_RULE_WINDING
+    )
+    context.set_source_rgba(*_parse_color(color), opacity)
+    context.fill()
+    context.restore()
+
+
+def draw_shade_levels(
+        canvas: Canvas,
+        output_path: Path,
+        levels: List[ShadeLevel],
+        dark: bool,
+        width: Optional[Cu] = None
+):
+    """
+    Draws the traced layers of a hillshade, colored for the theme.
+
+    :param canvas:
+    :param output_path: The directory the hillshade's layers were traced to.
+    :param levels:
+    :param dark: Whether to use the dark theme's opacities.
+    :param width: See `draw_shade_layer`.
+    :return:
+    """
+    theme = 'dark' if dark else 'light'
+    for level in levels:
+        draw_shade_layer(
+            canvas,
+            load_shade_layer(traced_svg_path(output_path, level)),
+            level.color,
+            level.opacity(theme),
+            width
+        )
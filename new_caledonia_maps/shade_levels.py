@@ -0,0 +1,86 @@
+from pathlib import Path
+from typing import NamedTuple
+
+# The shade levels of each map's hillshade, and where they are traced to.
+# They are kept apart from the hillshade scripts, so that the maps can draw
+# the traced layers without importing GDAL.
+root_path = Path(__file__).parent.parent
+preview_filepath = 'data/preview_shaded_relief/'
+overview_filepath = 'data/overview_shaded_relief/'
+panama_filepath = 'data/panama_shaded_relief/'
+preview_output_path = root_path.joinpath(preview_filepath)
+overview_output_path = root_path.joinpath(overview_filepath)
+panama_output_path = root_path.joinpath(panama_filepath)
+# In the SRTM hillshade tif, flat slopes are this shade of gray.
+srtm_threshold_midpoint = 181 / 255
+# In the world tif, flat slopes are this shade of gray.
+world_threshold_midpoint = 206 / 255
+
+
+class ShadeLevel(NamedTuple):
+    """
+    A brightness threshold of a hillshade that is traced into an SVG layer.
+    """
+    name: str
+    threshold: float
+    # If true, the pixels brighter than the threshold are traced, otherwise
+    # the pixels darker than it.
+    invert: bool
+    color: str
+    light_opacity: float
+    dark_opacity: float
+
+    def opacity(self, theme: str) -> float:
+        return self.light_opacity if theme == 'light' else self.dark_opacity
+
+
+def _level_name(level: ShadeLevel) -> str:
+    return '%s_%.2f' % (level.name, level.threshold)
+
+
+def traced_svg_path(output_path: Path, level: ShadeLevel) -> Path:
+    """
+    Returns where a shade level of a hillshade is traced to. The layer has no
+    theme: its color and opacity are applied when it is drawn.
+    """
+    return output_path.joinpath('%s.svg' % _level_name(level))
+
+
+# Generate the **highlight** and **shadow** specs of the preview and
+# overview hillshades as SVGs at different brightness thresholds.
+preview_shade_levels = [
+    ShadeLevel(
+        'highlight', srtm_threshold_midpoint + delta, True, '#FFF', 0.1, 0.05
+    )
+    for delta in [0.05, 0.10, 0.15]
+] + [
+    ShadeLevel(
+        'shadow', srtm_threshold_midpoint - delta, False, '#000', 0.05, 0.05
+    )
+    for delta in [0.05, 0.10, 0.15, 0.25, 0.40]
+]
+overview_shade_levels = [
+    ShadeLevel(
+        'highlight', srtm_threshold_midpoint + delta, True, '#FFF', 0.1, 0.05
+    )
+    for delta in [0.05, 0.10, 0.15]
+] + [
+    ShadeLevel(
+        'shadow', srtm_threshold_midpoint - delta, False, '#000', 0.05, 0.05
+    )
+    for delta in [0.05, 0.10, 0.15, 0.25, 0.40]
+]
+
+# Generate the **white** and **black** specs of the Panama hillshade as SVGs
+# at different brightness thresholds.
+panama_shade_levels = [
+    ShadeLevel(
+        'white', world_threshold_midpoint + delta, True, '#FFF', 0.2, 0.1
+    )
+    for delta in [0.05, 0.10, 0.15]
+] + [
+    ShadeLevel(
+        'black', world_threshold_midpoint - delta, False, '#000', 0.1, 0.1
+    )
+    for delta in [0.05, 0.10, 0.15, 0.25, 0.40]
+]
@@ -0,0 +1,261 @@
+import math
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import shapely
+from osgeo import gdal
+
+from new_caledonia_maps.parallel import thread_map
+
+# Hillshades are bytes, so their brightness comes in this many steps.
+shade_steps = 255
+# The segments of each marching squares case, as pairs of cell edges. Cases
+# are numbered by which corners are inside the traced area: top-left (8),
+# top-right (4), bottom-right (2) and bottom-left (1). The saddles 5 and 10
+# are resolved separately, depending on the value at the cell's centre.
+_T, _R, _B, _L = range(4)
+_case_segments = {
+    1: [(_L, _B)],
+    2: [(_B, _R)],
+    3: [(_L, _R)],
+    4: [(_T, _R)],
+    6: [(_T, _B)],
+    7: [(_T, _L)],
+    8: [(_T, _L)],
+    9: [(_T, _B)],
+    11: [(_T, _R)],
+    12: [(_L, _R)],
+    13: [(_B, _R)],
+    14: [(_L, _B)],
+}
+_saddle_segments = {
+    # (case, centre is inside): segments
+    (5, True): [(_T, _L), (_B, _R)],
+    (5, False): [(_T, _R), (_L, _B)],
+    (10, True): [(_T, _R), (_L, _B)],
+    (10, False): [(_T, _L), (_B, _R)],
+}
+
+
+def read_shade(tif_path: Path) -> np.ndarray:
+    """
+    Reads the first band of a hillshade as brightness values between 0 and 1.
+    """
+    gdal.UseExceptions()
+    dataset = gdal.Open(tif_path.as_posix())
+    band = dataset.GetRasterBand(1)
+    values = band.ReadAsArray().astype(np.float64)
+    return values / shade_steps
+
+
+def _between_steps(threshold: float, invert: bool) -> float:
+    """
+    Moves a threshold halfway between two brightness steps, without changing
+    which pixels it selects, so that no pixel lies exactly on it. Pixels on
+    the threshold are not traced, like potrace.
+    """
+    # Rounded first, so that a threshold that is a step in all but floating
+    # point error is treated as that step.
+    step = round(threshold * shade_steps, 6)
+    if invert:
+        return (math.floor(step) + 0.5) / shade_steps
+    return (math.ceil(step) - 0.5) / shade_steps
+
+
+def contour_rings(field: np.ndarray) -> List[np.ndarray]:
+    """
+    Traces the boundary of the area where `field` is positive with marching
+    squares, interpolating between pixel centres, so that the outlines are
+    smooth rather than following the pixel edges.
+
+    The field is padded with a negative border, so every outline is closed.
+    Filling all the rings with the even-odd rule reproduces the area, holes
+    included.
+
+    :param field: A 2D array, positive inside the traced area. Values of
+                  exactly 0 put crossings on pixel centres, where outlines
+                  can meet and fail to close, so they should be avoided.
+    :return: The closed rings, as arrays of `(x, y)` pixel coordinates, where
+             the centre of the top-left pixel is `(0.5, 0.5)`.
+    """
+    f = np.pad(field.astype(np.float64), 1, constant_values=-1)
+    inside = f > 0
+
+    # The interpolated position of the crossing on every horizontal and
+    # vertical edge between pixel centres. Each crossing is computed once,
+    # so neighbouring cells share exactly the same points.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h_t = f[:, :-1] / (f[:, :-1] - f[:, 1:])
+        v_t = f[:-1, :] / (f[:-1, :] - f[1:, :])
+
+    tl = inside[:-1, :-1]
+    tr = inside[:-1, 1:]
+    br = inside[1:, 1:]
+    bl = inside[1:, :-1]
+    cases = tl * 8 + tr * 4 + br * 2 + bl * 1
+    centre_inside = (
+        f[:-1, :-1] + f[:-1, 1:] + f[1:, 1:] + f[1:, :-1]
+    ) > 0
+
+    def edge_points(edge: int, rows: np.ndarray, cols: np.ndarray):
+        if edge == _T:
+            return np.column_stack([cols + h_t[rows, cols], rows])
+        if edge == _B:
+            return np.column_stack([cols + h_t[rows + 1, cols], rows + 1])
+        if edge == _L:
+            return np.column_stack([cols, rows + v_t[rows, cols]])
+        return np.column_stack([cols + 1, rows + v_t[rows, cols + 1]])
+
+    segments = []
+    selections = [
+        (cases == case, pairs) for case, pairs in _case_segments.items()
+    ] + [
+        ((cases == case) & (centre_inside == is_inside), pairs)
+        for (case, is_inside), pairs in _saddle_segments.items()
+    ]
+    for selection, pairs in selections:
+        rows, cols = np.nonzero(selection)
+        if len(rows) == 0:
+            continue
+        for start, end in pairs:
+            segments.append(np.stack([
+                edge_points(start, rows, cols),
+                edge_points(end, rows, cols)
+            ], axis=1))
+    if len(segments) == 0:
+        return []
+
+    lines = shapely.line_merge(shapely.multilinestrings(
+        shapely.linestrings(np.concatenate(segments))
+    ))
+    lines = shapely.get_parts(lines)
+    if not np.all(shapely.is_closed(lines)):
+        raise Exception(
+            'The traced outlines are not closed; does the field have values '
+            'of exactly 0?'
+        )
+    # Undo the padding, and move to pixel centres.
+    return [shapely.get_coordinates(line) - 0.5 for line in lines]
+
+
+def trace_rings(
+        shade: np.ndarray,
+        threshold: float,
+        invert: bool,
+        speckle_area: float = 2,
+        tolerance: float = 0.2
+) -> List[np.ndarray]:
+    """
+    Traces the areas of a hillshade that are darker than a threshold, or
+    brighter if `invert` is set, like `potrace -k <threshold> [-i]`.
+
+    :param shade: The brightness values, between 0 and 1.
+    :param threshold: The brightness, between 0 and 1. Pixels exactly at the
+                      threshold are not traced.
+    :param invert:
+    :param speckle_area: Rings enclosing at most this many pixels are
+                         dropped, like potrace's `--turdsize`.
+    :param tolerance: The rings are simplified to this tolerance in pixels.
+    :return:
+    """
+    threshold = _between_steps(threshold, invert)
+    field = shade - threshold if invert else threshold - shade
+    coords = contour_rings(field)
+    if len(coords) == 0:
+        return []
+    rings = shapely.linearrings(
+        np.concatenate(coords),
+        indices=np.repeat(np.arange(len(coords)), [len(c) for c in coords])
+    )
+    areas = shapely.area(shapely.polygons(rings))
+    rings = shapely.simplify(rings[areas > speckle_area], tolerance)
+    return [shapely.get_coordinates(ring) for ring in rings]
+
+
+def rings_to_path_data(rings: List[np.ndarray]) -> str:
+    """
+    Converts rings to SVG path data, fitting a smooth quadratic B-spline
+    through the vertices of each ring. Each curve runs between the midpoints
+    of consecutive edges, with the vertex between them as its control point.
+    """
+    commands = []
+    for ring in rings:
+        # Rings are closed, so drop the repeated end point.
+        points = ring[:-1]
+        if len(points) < 3:
+            continue
+        midpoints = (points + np.roll(points, -1, axis=0)) / 2
+        commands.append('M%.2f %.2f' % tuple(midpoints[-1]))
+        commands.append(''.join(
+            'Q%.2f %.2f %.2f %.2f' % (cx, cy, x, y)
+            for (cx, cy), (x, y) in zip(points, midpoints)
+        ))
+        commands.append('Z')
+    return ''.join(commands)
+
+
+def write_svg(
+        svg_path: Path,
+        width: int,
+        height: int,
+        rings: List[np.ndarray]
+):
+    """
+    Writes traced rings as an SVG laid out like potrace's output, so that
+    `shade_layer` draws the output of either tracer in the same way.
+    """
+    svg_path.write_text(
+        '<?xml version="1.0" standalone="no"?>\n'
+        '<svg version="1.0" xmlns="http://www.w3.org/2000/svg"\n'
+        ' width="%fpt" height="%fpt" viewBox="0 0 %f %f"\n'
+        ' preserveAspectRatio="xMidYMid meet">\n'
+        '<g fill="#000000" stroke="none">\n'
+        '<path fill-rule="evenodd" d="%s"/>\n'
+        '</g>\n'
+        '</svg>\n' % (
+            width, height, width, height, rings_to_path_data(rings)
+        )
+    )
+
+
+def trace_levels(
+        tif_path: Path,
+        traces: List[Tuple[Path, float, bool]]
+):
+    """
+    Traces a hillshade at several brightness thresholds, reading it only
+    once. Every level is a contour of the same interpolated brightness, so
+    the outlines of the levels nest inside each other without crossing, and
+    levels that share a boundary trace it identically.
+
+    :param tif_path: The hillshade.
+    :param traces: The SVG to write, the threshold and whether to invert,
+                   for each level. See `trace_rings`.
+    :return:
+    """
+    shade = read_shade(tif_path)
+    height, width = shade.shape
+
+    def trace_level(level: Tuple[Path, float, bool]):
+        svg_path, threshold, invert = level
+        write_svg(
+            svg_path,
+            width,
+            height,
+            trace_rings(shade, threshold, invert)
+        )
+
+    thread_map(trace_level, traces)
+
+
+def trace(
+        tif_path: Path,
+        svg_path: Path,
+        threshold: float,
+        invert: bool
+):
+    """
+    Traces a hillshade at a brightness threshold into an SVG, in-process.
+    """
+    trace_levels(tif_path, [(svg_path, threshold, invert)])
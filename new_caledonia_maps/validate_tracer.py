@@ -0,0 +1,154 @@
+import io
+from pathlib import Path
+from typing import Tuple
+
+import cairosvg
+import click
+import numpy as np
+from PIL import Image
+
+from new_caledonia_maps import overview_hillshade, panama_hillshade, \
+    preview_hillshade, tracer
+from new_caledonia_maps.cache import cache_path
+from new_caledonia_maps.hillshade import docker_batch, potrace_command, \
+    tiff_to_pnm_command
+from new_caledonia_maps.parallel import thread_map
+from new_caledonia_maps.shade_levels import ShadeLevel, \
+    overview_shade_levels, panama_shade_levels, preview_shade_levels
+
+# Compares the in-process tracer against potrace, by rasterizing both traces
+# of every shade level and measuring how much of their area overlaps.
+validation_path = cache_path.joinpath('validate_tracer')
+hillshades = {
+    'preview': (
+        preview_hillshade.preview_tif_path,
+        preview_shade_levels
+    ),
+    'overview': (
+        overview_hillshade.overview_tif_path,
+        overview_shade_levels
+    ),
+    'panama': (
+        panama_hillshade.panama_tif_path,
+        panama_shade_levels
+    ),
+}
+
+
+def rasterize(svg_path: Path, width: int, height: int) -> np.ndarray:
+    """
+    Returns a mask of the pixels covered by an SVG.
+    """
+    png = cairosvg.svg2png(
+        url=svg_path.as_posix(),
+        output_width=width,
+        output_height=height
+    )
+    image = Image.open(io.BytesIO(png)).convert('RGBA')
+    return np.asarray(image)[:, :, 3] > 127
+
+
+def trace_paths(output_path: Path, level: ShadeLevel) -> Tuple[Path, Path]:
+    """
+    Returns where the potrace and builtin traces of a shade level are saved.
+    """
+    level_name = '%s_%.2f' % (level.name, level.threshold)
+    return (
+        output_path.joinpath('potrace_%s.svg' % level_name),
+        output_path.joinpath('builtin_%s.svg' % level_name)
+    )
+
+
+def compare_level(
+        output_path: Path,
+        width: int,
+        height: int,
+        level: ShadeLevel
+) -> Tuple[float, float]:
+    """
+    Compares the potrace and builtin traces of a shade level.
+
+    :return: The intersection over union of the two traces, and the share of
+             the image's pixels they disagree on.
+    """
+    potrace_path, builtin_path = trace_paths(output_path, level)
+    expected = rasterize(potrace_path, width, height)
+    actual = rasterize(builtin_path, width, height)
+    union = np.count_nonzero(expected | actual)
+    intersection = np.count_nonzero(expected & actual)
+    iou = intersection / union if union > 0 else 1
+    return iou, np.count_nonzero(expected ^ actual) / expected.size
+
+
+@click.command()
+@click.option(
+    "--map",
+    "map_names",
+    type=click.Choice(list(hillshades.keys())),
+    multiple=True,
+    help='The hillshades to compare. Defaults to every hillshade.'
+)
+@click.option(
+    "--min-iou",
+    type=float,
+    default=0.9,
+    help='Fails if any level overlaps the potrace trace by less than this.'
+)
+def validate(map_names: Tuple[str, ...], min_iou: float):
+    """
+    Compares the in-process tracer with potrace on the projected hillshades,
+    which must already have been built.
+    """
+    failures = []
+    for map_name in map_names or hillshades.keys():
+        tif_path, levels = hillshades[map_name]
+        output_path = validation_path.joinpath(map_name)
+        output_path.mkdir(parents=True, exist_ok=True)
+        pnm_path = output_path.joinpath('projected.pnm')
+        # Every potrace trace of the map runs in one docker container.
+        docker_batch([
+            [tiff_to_pnm_command(tif_path, pnm_path)],
+            [
+                potrace_command(
+                    pnm_path,
+                    trace_paths(output_path, level)[0],
+                    level.threshold,
+                    level.invert
+                )
+                for level in levels
+            ]
+        ])
+
+        tracer.trace_levels(tif_path, [
+            (trace_paths(output_path, level)[1], level.threshold, level.invert)
+            for level in levels
+        ])
+
+        height, width = tracer.read_shade(tif_path).shape
+        results = thread_map(
+            lambda level: compare_level(output_path, width, height, level),
+            levels
+        )
+        for level, (iou, difference) in zip(levels, results):
+            print('%-9s %-9s %.2f  IoU %.3f  differing pixels %5.2f%%' % (
+                map_name,
+                level.name,
+                level.threshold,
+                iou,
+                difference * 100
+            ))
+            if iou < min_iou:
+                failures.append('%s %s %.2f' % (
+                    map_name,
+                    level.name,
+                    level.threshold
+                ))
+
+    if len(failures) > 0:
+        raise Exception(
+            'The traces differ from potrace for %s' % ', '.join(failures)
+        )
+
+
+if __name__ == '__main__':
+    validate()